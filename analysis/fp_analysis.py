@@ -1,7 +1,15 @@
+import os
+import sys
 import math
 import json
 import random
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from zardaxt_numpy_scoring import NumpyScorer, np
+
+# the order of score_fp(), max() picks the first of equal scores
+OS_CLASSES = ['Android', 'Windows', 'Mac OS', 'iOS', 'Linux', 'Chromium OS']
+
 
 def get_data():
     data = []
@@ -74,6 +82,27 @@ def score_fp(fp, fpList, use_ip_total_length=False, use_tcp_off=False):
     return avg_os_score
 
 
+def field_weights(use_ip_total_length=False, use_tcp_off=False):
+    """The weights of score_fp(), without tcp_options and tcp_options_ordered."""
+    weights = [('ip_id', 1.5), ('ip_tos', 0.25)]
+    if use_ip_total_length:
+        weights.append(('ip_total_length', 2.5))
+    weights.append(('ip_ttl', 2))
+    if use_tcp_off:
+        weights.append(('tcp_off', 2.5))
+    weights += [('tcp_timestamp_echo_reply', 2), ('tcp_window_scaling', 2),
+                ('tcp_window_size', 2), ('tcp_flags', 0.25), ('tcp_mss', 1.5)]
+    return weights
+
+
+def score_fps(fps, fpList, use_ip_total_length=False, use_tcp_off=False):
+    """The scores of score_fp() for all fingerprints, vectorized if NumPy is installed."""
+    if np is None:
+        return [score_fp(fp, fpList, use_ip_total_length, use_tcp_off) for fp in fps]
+    scorer = NumpyScorer(fpList, field_weights(use_ip_total_length, use_tcp_off), OS_CLASSES)
+    return scorer.score_many(fps)
+
+
 def get_learning_data(data, threshold=.8):
     num_training = math.floor(len(data) * threshold)
     random.shuffle(data)
@@ -106,8 +135,8 @@ def main():
     training, testing = get_learning_data(data, threshold=0.8)
     numFalse = 0
     numCorrect = 0
-    for fp in testing:
-        score = score_fp(fp, db, use_ip_total_length=False, use_tcp_off=False)
+    scores = score_fps(testing, db, use_ip_total_length=False, use_tcp_off=False)
+    for fp, score in zip(testing, scores):
         highest_os = max(score, key=score.get)
         same = same_os(highest_os, fp['os'])
         if not same:
@@ -0,0 +1,75 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+"""
+Restoring the fingerprint store in a process with a different hash seed.
+
+Run with: python -m unittest discover tests
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# fills a store, writes a snapshot and prints the IPs in update order
+WRITE = '''
+import sys
+from zardaxt_store import FingerprintStore
+from zardaxt_persist import Persistence
+store = FingerprintStore({'store_shards': 8})
+from zardaxt_bench import make_tcp_frame
+from zardaxt_parser import parse_syn
+frame = make_tcp_frame(b'\\x0a\\x00\\x00\\x01', b'\\x0a\\x00\\x00\\x02', 1000, 443, 2, b'\\x02\\x04\\x05\\xb4')
+fp = parse_syn(frame, (1690000000, 0), len(frame), len(frame))
+for i in range(300):
+    fp['src_ip'] = '10.0.0.{}'.format(i * 7 % 200)
+    store.add(dict(fp))
+Persistence({'persist_dir': sys.argv[1]}, store).write_snapshot()
+print(' '.join(ip for ip, _, _ in store.changes()[1]))
+'''
+
+# restores the store and pages through it with changes()
+READ = '''
+import sys
+from zardaxt_store import FingerprintStore
+from zardaxt_persist import Persistence
+store = FingerprintStore({'store_shards': 8})
+Persistence({'persist_dir': sys.argv[1]}, store).load()
+cursor, ips = 0, []
+while True:
+    cursor, changes = store.changes(cursor, limit=7)
+    if not changes:
+        break
+    ips.extend(ip for ip, _, _ in changes)
+print(' '.join(ips))
+'''
+
+
+def run(script, directory, seed):
+    env = dict(os.environ, PYTHONHASHSEED=str(seed), PYTHONPATH=ROOT)
+    out = subprocess.check_output([sys.executable, '-c', script, directory],
+                                  env=env, cwd=ROOT)
+    # the last line, the modules log to stdout as well
+    return out.decode().splitlines()[-1].split()
+
+
+class RestoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_changes_after_restore_with_other_hash_seed(self):
+        written = run(WRITE, self.directory, 1)
+        self.assertEqual(len(written), 200)
+        for seed in (2, 3, 4):
+            restored = run(READ, self.directory, seed)
+            # every IP exactly once, in update order
+            self.assertEqual(restored, written)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,26 @@
 import dpkt
-import socket
-from dpkt.tcp import parse_opts
-import pcapy
 import netifaces as ni
 import sys
 import signal
 import traceback
 import json
-from zardaxt_tcp_options import decode_tcp_options
-from zardaxt_utils import TH_SYN, TH_ACK, load_config, compute_near_timestamp_tick
-from zardaxt_logging import log
+import queue
+import time
+import threading
+from zardaxt_utils import load_config, compute_near_timestamp_tick, set_scoring_backend, configure_score_cache
+from zardaxt_logging import log, configure_logging
 from zardaxt_api import run_api
+from zardaxt_capture import open_live, run_capture, CaptureStats
+from zardaxt_filter import get_pcap_filter
+from zardaxt_parser import fingerprint_from_dpkt, parse_syn, maybe_client_syn
+from zardaxt_queue import BoundedQueue
+from zardaxt_metrics import set_metrics
+from zardaxt_store import FingerprintStore
+from zardaxt_persist import Persistence
+from zardaxt_classifier import Classifier
+from zardaxt_scoring_pool import ScoringPool
+from zardaxt_fanout import FanoutCapture
+from zardaxt_ring import TPacketV3Ring
 
 """
 Author: Nikolai Tschacher
@@ -35,34 +45,78 @@ def get_default_gateway_interface_name():
     default_gateway = gws['default'][ni.AF_INET][1]
     return default_gateway
 
+
+def get_interface_addresses(interface):
+    addresses = []
+    ifaddresses = ni.ifaddresses(interface)
+    for family in [ni.AF_INET, ni.AF_INET6]:
+        for addr in ifaddresses.get(family, []):
+            # strip the scope id of link local IPv6 addresses
+            addresses.append(addr['addr'].split('%')[0])
+    return addresses
+
 # do not modify those variables
 interface = get_default_gateway_interface_name()
 verbose = False
-fingerprints = {}
 timestamps = {}
 config = None
+frame_queue = None
 if len(sys.argv) == 2:
     config = load_config(sys.argv[1])
 else:
     config = load_config()
+configure_logging(config)
+set_scoring_backend(config.get('scoring_backend', 'table'))
+configure_score_cache(config.get('score_cache_size', 10000),
+                      config.get('score_cache_prewarm', False))
+fingerprints = FingerprintStore(config)
+# journal and snapshots of the store, replaces store_fingerprints
+persistence = Persistence(config, fingerprints) if config.get('persist_dir') else None
+# score the fingerprints when they are captured instead of on lookup
+classifier = Classifier(config, fingerprints) if config.get('classify_on_capture', False) else None
+# score API lookups in worker processes
+scoring_pool = ScoringPool(config) if config.get('scoring_workers', 0) > 0 else None
+# capture and parse in worker processes
+fanout = None
+if config.get('capture_workers', 0) > 0:
+    fanout = FanoutCapture(config, interface,
+                           get_pcap_filter(config, get_interface_addresses(interface)))
 
 
 def update_file():
     log('writing fingerprints.json with {} objects...'.format(
         len(fingerprints)), 'zardaxt')
     with open('fingerprints.json', 'w') as fp:
-        json.dump(fingerprints, fp, indent=2, sort_keys=False)
+        json.dump(fingerprints.snapshot(), fp, indent=2, sort_keys=False)
 
 
 def signal_handler(sig, frame):
-    update_file()
-    sys.exit(0)
+    # The main thread may be holding a store or logger lock right now, so
+    # only stop the capture loop here. shutdown() runs once it unwound.
+    raise KeyboardInterrupt
+
+
+def shutdown():
+    if persistence:
+        persistence.close()
+    else:
+        update_file()
 
 
 signal.signal(signal.SIGINT, signal_handler)  # ctlr + c
 signal.signal(signal.SIGTSTP, signal_handler)  # ctlr + z
 
 
+def store_fingerprint(fp):
+    log('SYN packet from {} to {}'.format(fp['src_ip'], fp['dst_ip']), 'zardaxt', category='syn')
+
+    fingerprints.add(fp)
+
+    if config.get('store_fingerprints', False) and not persistence:
+        if len(fingerprints) > 0 and len(fingerprints) % config.get('write_after', 1000) == 0:
+            update_file()
+
+
 def process_packet(ts, header_len, cap_len, ip_pkt, ip_version):
     """
     We are only considering TCP segments here.
@@ -70,150 +124,125 @@ def process_packet(ts, header_len, cap_len, ip_pkt, ip_version):
     It likely makes sense to also make a TCP/IP fingerprint for other
     TCP-like protocols such as QUIC, which builds on top of UDP.
     """
-    tcp_pkt = None
-
-    if ip_pkt.p == dpkt.ip.IP_PROTO_TCP:
-        tcp_pkt = ip_pkt.data
-
-    # Sometimes I get the following error in production:
-    # File "/root/zardaxt/zardaxt.py", line 74, in process_packet
-    # is_syn = tcp_pkt.flags & TH_SYN
-    # AttributeError: 'bytes' object has no attribute 'flags'
-
-    # Honestly I don't know why, let's use hasattr() to check that tcp_pkt
-    # has the flags attribute
-
-    if tcp_pkt and hasattr(tcp_pkt, 'flags'):
-        is_syn = tcp_pkt.flags & TH_SYN
-        is_ack = tcp_pkt.flags & TH_ACK
-
-        addr_fam = socket.AF_INET
-        if ip_version == 6:
-            addr_fam = socket.AF_INET6
-
-        src_ip = socket.inet_ntop(addr_fam, ip_pkt.src)
-        dst_ip = socket.inet_ntop(addr_fam, ip_pkt.dst)
-
-        # The reason we are looking for a TCP segment that has the SYN flag
-        # but not the ACK flag is that we are only interested in packets
-        # coming from client to server and not the SYN+ACK from server to client.
-        if is_syn and not is_ack:
-            log('SYN packet from {} to {}'.format(src_ip, dst_ip), 'zardaxt')
-            tcp_options = parse_opts(tcp_pkt.opts)
-            [str_opts, timestamp, timestamp_echo_reply, mss,
-                window_scaling] = decode_tcp_options(tcp_options)
-
-            ip_len = None
-            ip_ttl = None
-            if ip_version == 4:
-                ip_ttl = ip_pkt.ttl
-                ip_len = ip_pkt.len
-            elif ip_version == 6:
-                ip_len = len(ip_pkt)
-                # Hop Limit (8 bits)
-                # Replaces the time to live field in IPv4.
-                # This value is decremented by one at each forwarding node and the packet is discarded
-                # if it becomes 0. However, the destination node should process the packet normally
-                # even if received with a hop limit of 0.
-                ip_ttl = ip_pkt.hlim
-
-            if not fingerprints.get(src_ip, None):
-                fingerprints[src_ip] = []
-
-            fingerprints[src_ip].append({
-                'ts': ts,
-                'header_len': header_len,
-                'cap_len': cap_len,
-                'src_ip': src_ip,
-                'dst_ip': dst_ip,
-                'src_port': tcp_pkt.sport,
-                'dst_port': tcp_pkt.dport,
-                'ip_hdr_length': ip_pkt.hl if ip_version == 4 else None,
-                'ip_version': ip_pkt.v,
-                'ip_total_length': ip_len,
-                'ip_tos': ip_pkt.tos if ip_version == 4 else None,
-                'ip_id': ip_pkt.id if ip_version == 4 else None,
-                'ip_ttl': ip_ttl,
-                'ip_rf': ip_pkt.rf if ip_version == 4 else None,
-                'ip_df': ip_pkt.df if ip_version == 4 else None,
-                'ip_mf': ip_pkt.mf if ip_version == 4 else None,
-                'ip_off': ip_pkt.off if ip_version == 4 else None,
-                'ip_protocol': ip_pkt.p,
-                'ip_checksum': ip_pkt.sum if ip_version == 4 else None,
-                'ip_plen': ip_pkt.plen if ip_version == 6 else None,
-                'ip_nxt': ip_pkt.nxt if ip_version == 6 else None,
-                # @TODO: this is likely not what we want (Probably just take tcp_off instead)
-                'tcp_header_length': tcp_pkt.__hdr_len__,
-                'tcp_off': tcp_pkt.off,
-                'tcp_window_size': tcp_pkt.win,
-                'tcp_checksum': tcp_pkt.sum,
-                'tcp_flags': tcp_pkt.flags,
-                'tcp_ack': tcp_pkt.ack,
-                'tcp_seq': tcp_pkt.seq,
-                'tcp_urp': tcp_pkt.urp,
-                'tcp_options': str_opts,
-                'tcp_options_ordered': ''.join(
-                    [e[0] for e in str_opts.split(',') if e]),
-                'tcp_window_scaling': window_scaling,
-                'tcp_timestamp': timestamp,
-                'tcp_timestamp_echo_reply': timestamp_echo_reply,
-                'tcp_mss': mss
-            })
-
-            if len(fingerprints) > config.get('clear_dict_after', 5000):
-                log('Clearing fingerprints dict', 'zardaxt')
-                fingerprints.clear()
-                timestamps.clear()
-
-            if config.get('store_fingerprints', False):
-                if len(fingerprints) > 0 and len(fingerprints) % config.get('write_after', 1000) == 0:
-                    update_file()
+    fp = fingerprint_from_dpkt(ts, header_len, cap_len, ip_pkt, ip_version)
+    if fp:
+        store_fingerprint(fp)
+
+
+def handle_frame(ts, header_len, cap_len, buf):
+    eth = dpkt.ethernet.Ethernet(bytes(buf))
+    # Ignore everything other than IPv4 or IPv6
+    if eth.type == dpkt.ethernet.ETH_TYPE_IP or eth.type == dpkt.ethernet.ETH_TYPE_IP6:
+        ip_pkt = eth.data
+
+        ip_version = 4
+        if eth.type == dpkt.ethernet.ETH_TYPE_IP6:
+            ip_version = 6
+
+        process_packet(ts, header_len, cap_len, ip_pkt, ip_version)
+
+
+def handle_frame_raw(ts, header_len, cap_len, buf):
+    fp = parse_syn(buf, ts, header_len, cap_len)
+    if fp:
+        store_fingerprint(fp)
+
+
+def handle_packet(header, buf):
+    handle_frame(header.getts(), header.getlen(), header.getcaplen(), buf)
+
+
+def handle_packet_raw(header, buf):
+    handle_frame_raw(header.getts(), header.getlen(), header.getcaplen(), buf)
+
+
+def enqueue_frame(ts, header_len, cap_len, buf):
+    """The capture stage: queue a copy of every possible client SYN for fingerprint_frames()."""
+    if maybe_client_syn(buf):
+        frame_queue.put((ts, header_len, cap_len, bytes(buf)))
+
+
+def enqueue_packet(header, buf):
+    enqueue_frame(header.getts(), header.getlen(), header.getcaplen(), buf)
+
+
+def fingerprint_frames(on_frame):
+    """The fingerprinting stage: parse, log and store the queued frames."""
+    interval = config.get('stats_interval', 60)
+    next_report = time.time() + interval
+    while True:
+        try:
+            on_frame(*frame_queue.get(timeout=1))
+        except queue.Empty:
+            pass
+        except Exception as err:
+            log("fingerprint_frames() failed with error: {} and stack: {}".format(
+                err, traceback.format_exc()), 'zardaxt', level='ERROR')
+        if time.time() >= next_report:
+            next_report = time.time() + interval
+            set_metrics('queue', frame_queue.stats())
 
 
 def main():
+    global frame_queue
     try:
         log('Listen on interface {}'.format(interface), 'zardaxt')
-        # snaplen (maximum number of bytes to capture per packet)
-        # 120 bytes are picked, since the maximum TCP header is 60 bytes and the maximum IP header is also 60 bytes
-        # The IPv6 header is always present and is a fixed size of 40 bytes.
-        max_bytes = 120
-        # promiscuous mode (1 for true)
-        promiscuous = False
-        # https://github.com/the-tcpdump-group/libpcap/issues/572
-        # The main purpose of timeouts in packet capture mechanisms is to allow the capture mechanism
-        # to buffer up multiple packets, and deliver multiple packets in a single wakeup, rather than one
-        # wakeup per packet, reducing the number of wakeups (which aren't free),
-        # timeout (in milliseconds)
-        read_timeout = 1
-
-        # Read from the network interface in live mode
-        preader = pcapy.open_live(interface, max_bytes, promiscuous, read_timeout)
+        if fanout:
+            # capture and parse in worker processes, store in this one
+            return fanout.run(store_fingerprint)
+
+        pcap_filter = get_pcap_filter(
+            config, get_interface_addresses(interface))
+
+        raw_parser = config.get('packet_parser', 'raw') == 'raw'
+        on_frame = handle_frame_raw if raw_parser else handle_frame
+        on_packet = handle_packet_raw if raw_parser else handle_packet
+        if config.get('capture_queue_size', 10000) > 0:
+            # only copy the frame in the capture loop, parse and store in another thread
+            frame_queue = BoundedQueue(config.get('capture_queue_size', 10000),
+                                       config.get('capture_queue_policy', 'drop_newest'))
+            threading.Thread(target=fingerprint_frames, args=(on_frame,), daemon=True).start()
+            on_frame = enqueue_frame
+            on_packet = enqueue_packet
+
+        capture_backend = config.get('capture_backend', 'pcapy')
+        if capture_backend == 'tpacket_v3':
+            ring = TPacketV3Ring(interface, pcap_filter, config)
+            capture_stats = CaptureStats(ring, interface, config)
+            return ring.run(on_frame, capture_stats.maybe_report)
+        elif capture_backend != 'pcapy':
+            raise Exception('Unknown capture_backend: {}'.format(capture_backend))
+
+        preader = open_live(interface, config)
 
         # Filter certain traffic
-        preader.setfilter(config.get('pcap_filter', ''))
-
-        while True:
-            (header, buf) = preader.next()
-            eth = dpkt.ethernet.Ethernet(buf)
-            # Ignore everything other than IPv4 or IPv6
-            if eth.type == dpkt.ethernet.ETH_TYPE_IP or eth.type == dpkt.ethernet.ETH_TYPE_IP6:
-                ip_pkt = eth.data
-                header_len = header.getlen()
-                cap_len = header.getcaplen()
-                ts = header.getts()
-
-                ip_version = 4
-                if eth.type == dpkt.ethernet.ETH_TYPE_IP6:
-                    ip_version = 6
-
-                process_packet(ts, header_len, cap_len, ip_pkt, ip_version)
+        preader.setfilter(pcap_filter)
+
+        capture_stats = CaptureStats(preader, interface, config, pcap_filter)
+        run_capture(preader, config, on_packet, capture_stats.maybe_report)
     except Exception as err:
         log("main() crashed with error: {} and stack: {}".format(
             err, traceback.format_exc()), 'api', level='ERROR')
 
 
 if __name__ == '__main__':
+    # fork the workers before the persistence, API and capture threads run
+    if fanout:
+        fanout.start()
+    if scoring_pool:
+        scoring_pool.start()
+    if persistence:
+        # restore the fingerprints before the API answers lookups
+        persistence.load()
+        persistence.start()
+    if classifier:
+        # classifies the restored fingerprints first, then the new ones
+        classifier.start()
     # run the API thread
-    run_api(config, fingerprints, timestamps)
+    run_api(config, fingerprints, timestamps, scoring_pool)
     # run pcap loop
-    main()
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
+    shutdown()
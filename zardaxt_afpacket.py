@@ -0,0 +1,171 @@
+import ctypes
+import socket
+import struct
+from zardaxt_filter import build_syn_filter
+
+"""
+Linux AF_PACKET socket helpers.
+
+Used by the capture backends that do not go through pcapy:
+the PACKET_FANOUT capture workers and the TPACKET_V3 ring.
+"""
+
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+SO_ATTACH_FILTER = 26
+SO_TIMESTAMP = 29
+PACKET_STATISTICS = 6
+PACKET_FANOUT = 18
+PACKET_FANOUT_DATA = 22
+PACKET_FANOUT_HASH = 0
+PACKET_FANOUT_CBPF = 6
+
+# Classic BPF opcodes
+BPF_LD_H_ABS = 0x28
+BPF_LD_W_ABS = 0x20
+BPF_LD_B_ABS = 0x30
+BPF_LD_B_IND = 0x50
+BPF_LDX_B_MSH = 0xb1
+BPF_JEQ_K = 0x15
+BPF_JSET_K = 0x45
+BPF_JA = 0x05
+BPF_ALU_AND_K = 0x54
+BPF_ALU_MOD_K = 0x94
+BPF_RET_A = 0x16
+BPF_RET_K = 0x06
+
+SOCK_FILTER = struct.Struct('HBBI')
+# struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+SOCK_FPROG = struct.Struct('HP')
+# struct tpacket_stats { tp_packets; tp_drops; }, TPACKET_V3 appends tp_freeze_q_cnt
+TPACKET_STATS = struct.Struct('II')
+
+
+def open_socket(interface):
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                         socket.htons(ETH_P_ALL))
+    sock.bind((interface, ETH_P_ALL))
+    return sock
+
+
+def read_packet_statistics(sock):
+    """The packets received and dropped by the socket since the last call.
+
+    The kernel resets the counters on every read.
+
+    Returns:
+        (int, int): tp_packets (including the dropped ones) and tp_drops
+    """
+    data = sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, TPACKET_STATS.size + 4)
+    return TPACKET_STATS.unpack(data[:TPACKET_STATS.size])
+
+
+def set_bpf_program(sock, level, optname, instructions):
+    """Pass a classic BPF program (list of (code, jt, jf, k) tuples) to setsockopt()."""
+    program = b''.join(SOCK_FILTER.pack(*instruction) for instruction in instructions)
+    # the kernel copies the program during setsockopt(), the buffer only has to
+    # stay alive until then
+    program_buffer = ctypes.create_string_buffer(program, len(program))
+    fprog = SOCK_FPROG.pack(len(instructions), ctypes.addressof(program_buffer))
+    sock.setsockopt(level, optname, fprog)
+
+
+def syn_only_program(snaplen):
+    """The generated SYN only filter (build_syn_filter() without ports and addresses).
+
+    Assembled by hand, so that it can be attached without libpcap. Accepted
+    packets are truncated to snaplen bytes.
+    """
+    return [
+        (BPF_LD_H_ABS, 0, 0, 12),            # ethertype
+        (BPF_JEQ_K, 0, 8, 0x0800),
+        (BPF_LD_B_ABS, 0, 0, 14 + 9),        # IPv4 protocol
+        (BPF_JEQ_K, 0, 13, 6),
+        (BPF_LD_H_ABS, 0, 0, 14 + 6),        # IPv4 flags and fragment offset
+        (BPF_JSET_K, 11, 0, 0x1FFF),         # not the first fragment
+        (BPF_LDX_B_MSH, 0, 0, 14),           # X = IPv4 header length
+        (BPF_LD_B_IND, 0, 0, 14 + 13),       # TCP flags
+        (BPF_ALU_AND_K, 0, 0, 0x12),
+        (BPF_JEQ_K, 6, 7, 0x02),             # SYN set, ACK not set
+        (BPF_JEQ_K, 0, 6, 0x86DD),
+        (BPF_LD_B_ABS, 0, 0, 14 + 6),        # IPv6 next header
+        (BPF_JEQ_K, 0, 4, 6),
+        (BPF_LD_B_ABS, 0, 0, 14 + 40 + 13),  # TCP flags
+        (BPF_ALU_AND_K, 0, 0, 0x12),
+        (BPF_JEQ_K, 0, 1, 0x02),
+        (BPF_RET_K, 0, 0, snaplen),
+        (BPF_RET_K, 0, 0, 0),
+    ]
+
+
+def compile_filter(pcap_filter, snaplen=262144):
+    """Compile a pcap filter expression to classic BPF with libpcap.
+
+    Returns:
+        list: The (code, jt, jf, k) instructions, None if the expression
+            cannot be compiled because pcapy is not available
+    """
+    if not pcap_filter:
+        return None
+    try:
+        import pcapy
+    except ImportError:
+        if pcap_filter == build_syn_filter():
+            return syn_only_program(snaplen)
+        return None
+    program = pcapy.compile(pcapy.DLT_EN10MB, snaplen, pcap_filter, 1, 0)
+    return [tuple(instruction) for instruction in program.get_bpf()]
+
+
+def attach_filter(sock, pcap_filter, snaplen=262144):
+    """Attach the pcap filter expression as socket filter.
+
+    Packets matching the filter are truncated to snaplen bytes.
+
+    Returns:
+        bool: True if the filter was attached
+    """
+    instructions = compile_filter(pcap_filter, snaplen)
+    if not instructions:
+        return False
+    set_bpf_program(sock, socket.SOL_SOCKET, SO_ATTACH_FILTER, instructions)
+    return True
+
+
+def source_fanout_program(num_workers):
+    """A fanout program that selects the worker by the source address.
+
+    The worker index is the last 32 bits of the IPv4 or IPv6 source address
+    modulo num_workers, so all packets of one client land on the same worker.
+    Other packets go to worker 0.
+    """
+    return [
+        (BPF_LD_H_ABS, 0, 0, 12),            # ethertype
+        (BPF_JEQ_K, 0, 2, 0x0800),
+        (BPF_LD_W_ABS, 0, 0, 14 + 12),       # IPv4 source address
+        (BPF_JA, 0, 0, 2),
+        (BPF_JEQ_K, 0, 3, 0x86DD),
+        (BPF_LD_W_ABS, 0, 0, 14 + 8 + 12),   # last 4 bytes of the IPv6 source address
+        (BPF_ALU_MOD_K, 0, 0, num_workers),
+        (BPF_RET_A, 0, 0, 0),
+        (BPF_RET_K, 0, 0, 0),
+    ]
+
+
+def join_fanout(sock, group_id, num_workers, mode='source'):
+    """Join the PACKET_FANOUT group group_id.
+
+    Args:
+        mode (str): 'source' distributes packets by source address,
+            'hash' uses the kernel flow hash (per connection)
+    """
+    if mode == 'source':
+        sock.setsockopt(SOL_PACKET, PACKET_FANOUT,
+                        (group_id & 0xFFFF) | (PACKET_FANOUT_CBPF << 16))
+        set_bpf_program(sock, SOL_PACKET, PACKET_FANOUT_DATA,
+                        source_fanout_program(num_workers))
+    elif mode == 'hash':
+        sock.setsockopt(SOL_PACKET, PACKET_FANOUT,
+                        (group_id & 0xFFFF) | (PACKET_FANOUT_HASH << 16))
+    else:
+        raise Exception('Unknown fanout_mode: {}'.format(mode))
@@ -1,27 +1,139 @@
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import _thread
+import copy
 import json
 import socket
+import threading
 import traceback
+import zlib
+import zardaxt_utils
 from zardaxt_logging import log
 from dune_client import incr
 from urllib.parse import urlparse, parse_qs
-from zardaxt_utils import make_os_guess
+from zardaxt_cache import LRUCache
+from zardaxt_utils import make_os_guess, get_score_cache_stats, current_scores, batch_os_scores
+from zardaxt_tcp_options import get_options_cache_stats
+from zardaxt_metrics import get_metrics, set_metrics
+from zardaxt_queue import BoundedQueue
+
+try:
+    import orjson
+except ImportError:
+    # responses are encoded with json
+    orjson = None
+
+# /all writes its lines in chunks of about this many bytes
+EXPORT_CHUNK_SIZE = 64 * 1024
+# the request body of a batch lookup may have this many bytes per lookup
+MAX_LOOKUP_BYTES = 1024
+
+
+# infer the base operating system from the user-agent
+def user_agent_os(user_agent):
+    if user_agent:
+        userAgentOS = 'win'
+        if 'Linux' in user_agent or 'Android' in user_agent:
+            userAgentOS = 'linux'
+        if 'Mac OS' in user_agent or 'iPhone' in user_agent:
+            userAgentOS = 'mac'
+        return userAgentOS
+
+
+def encode_json(payload, compact=True):
+    """The payload as JSON bytes with sorted keys.
+
+    Compact JSON is encoded with orjson if it is installed. The indented
+    JSON is exactly what json.dumps() always sent.
+    """
+    if not compact:
+        return bytes(json.dumps(payload, indent=2, sort_keys=True), "utf-8")
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. an integer above 64 bit, json can encode it
+            pass
+    return bytes(json.dumps(payload, separators=(',', ':'), sort_keys=True), "utf-8")
 
 
 class HTTPServerIPv6(HTTPServer):
     address_family = socket.AF_INET6
 
 
+class ThreadPoolHTTPServer(HTTPServerIPv6):
+    """
+    Handles the connections with a fixed number of worker threads.
+
+    A worker serves all requests of a (keep-alive) connection, until the
+    client closes it or it is idle for api_keepalive_timeout seconds.
+    Connections that arrive while all workers are busy wait in a queue of
+    api_max_pending connections, when it is full they are closed.
+    """
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler, num_workers, max_pending):
+        super().__init__(server_address, handler)
+        self.num_workers = num_workers
+        self.pending = BoundedQueue(max_pending, 'drop_newest')
+        for i in range(num_workers):
+            threading.Thread(target=self.work, name='zardaxt-api-{}'.format(i),
+                             daemon=True).start()
+
+    def process_request(self, request, client_address):
+        if not self.pending.put((request, client_address)):
+            self.shutdown_request(request)
+        set_metrics('api', self.stats())
+
+    def work(self):
+        while True:
+            request, client_address = self.pending.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def stats(self):
+        values = self.pending.stats()
+        values['workers'] = self.num_workers
+        values['connections'] = values.pop('enqueued')
+        values['rejected'] = values.pop('dropped')
+        return values
+
+
 class ZardaxtApiServer(BaseHTTPRequestHandler):
-    def __init__(self, config, fingerprints, timestamps):
+    # keep-alive, every response has a Content-Length
+    protocol_version = 'HTTP/1.1'
+    # the response headers and body are written separately
+    disable_nagle_algorithm = True
+    # set when the status line of the response to the current request is written
+    response_started = False
+
+    def __init__(self, config, fingerprints, timestamps, scoring_pool=None):
         self.config = config
         self.fingerprints = fingerprints
         self.timestamps = timestamps
+        # scores the fingerprints in worker processes, see zardaxt_scoring_pool.py
+        self.scorer = scoring_pool.score if scoring_pool else None
+        self.batch_scorer = scoring_pool.score_many if scoring_pool else None
+        self.max_batch_size = config.get('api_max_batch_size', 1000)
+        # the maximum wait=<ms> of /classify
+        self.max_wait = config.get('api_max_wait', 1000)
+        # close idle keep-alive connections after this many seconds
+        self.timeout = config.get('api_keepalive_timeout', 5)
+        # both change the responses existing consumers get, thus opt-in
+        self.compact_json = config.get('api_compact_json', False)
+        self.json_content_type = config.get('api_json_content_type', 'text/json')
+        # (lookup ip, client ip, detailed, user agent os) -> ((seq, SYNs, database generation), body, etag)
+        # of the /classify responses, see handle_lookup()
+        cache_size = config.get('api_response_cache_size', 10000)
+        self.response_cache = LRUCache(cache_size) if cache_size > 0 else None
 
     def __call__(self, *args, **kwargs):
         """ Handle a request """
-        super().__init__(*args, **kwargs)
+        # connections are handled concurrently, each with its own handler
+        BaseHTTPRequestHandler.__init__(copy.copy(self), *args, **kwargs)
 
     def get_ip(self):
         ip = self.client_address[0]
@@ -38,35 +150,110 @@ class ZardaxtApiServer(BaseHTTPRequestHandler):
         if arg and len(arg) > 0:
             return arg[0].strip()
 
+    def parse_request(self):
+        self.response_started = False
+        return BaseHTTPRequestHandler.parse_request(self)
+
+    def send_response(self, code, message=None):
+        self.response_started = True
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def handle_failure(self, method, e):
+        traceback_str = ''.join(traceback.format_tb(e.__traceback__))
+        msg = f'{method}() failed: {e} with traceback {traceback_str}'
+        log(msg, 'api', level='ERROR')
+        self.close_connection = True
+        # a second response would end up in the body of the first one
+        # (or fail again on a broken connection)
+        if not self.response_started:
+            self.deny()
+
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         BaseHTTPRequestHandler.end_headers(self)
 
+    def send_body(self, status, body, content_type=None, headers=()):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-type", content_type)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
     def send_json(self, payload):
+        self.send_body(200, encode_json(payload, self.compact_json), self.json_content_type)
+
+    def send_cached(self, body, etag):
+        """Send a /classify response, or 304 if the client has it already."""
+        headers = [("ETag", etag), ("Cache-Control", "no-cache")]
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in (
+                tag.strip().replace('W/', '', 1) for tag in if_none_match.split(','))):
+            self.send_response(304)
+            for name, value in headers:
+                self.send_header(name, value)
+            if self.close_connection:
+                self.send_header("Connection", "close")
+            self.end_headers()
+            return
+        self.send_body(200, body, self.json_content_type, headers)
+
+    def send_stream(self, chunks, content_type, headers=()):
+        """Send the chunks as they are produced, gzip compressed if the client accepts it.
+
+        Uses chunked transfer encoding, with HTTP/1.0 the connection is
+        closed after the body instead.
+        """
+        compress = 'gzip' in (self.headers.get('Accept-Encoding') or '')
+        chunked = self.protocol_version == 'HTTP/1.1' and self.request_version == 'HTTP/1.1'
         self.send_response(200)
-        self.send_header("Content-type", "text/json")
+        self.send_header("Content-type", content_type)
+        for name, value in headers:
+            self.send_header(name, value)
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True
+            self.send_header("Connection", "close")
         self.end_headers()
-        self.wfile.write(
-            bytes(json.dumps(payload, indent=2, sort_keys=True), "utf-8"))
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        for data in chunks:
+            if compressor:
+                data = compressor.compress(data)
+            self.write_chunk(data, chunked)
+        if compressor:
+            self.write_chunk(compressor.flush(), chunked)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, data, chunked):
+        if not data:
+            # an empty chunk would end the body
+            return
+        if chunked:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
 
     def deny(self):
-        self.send_response(403)
-        self.end_headers()
-        self.wfile.write(
-            bytes("Access Denied", "utf-8"))
+        self.send_body(403, bytes("Access Denied", "utf-8"))
 
     def send_text(self, payload):
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
-        self.end_headers()
-        self.wfile.write(bytes(payload, "utf-8"))
+        self.send_body(200, bytes(payload, "utf-8"), "text/plain")
 
-    # infer the base operating system from the user-agent
-    # and then infer the operating system from the TCP/IP
+    def get_user_agent_os(self):
+        return user_agent_os(self.get_user_agent())
+
+    # infer the operating system from the TCP/IP
     # fingerprint and detect if there is a lie
-    def detect_os_mismatch(self, tcp_ip_fp):
-        user_agent = self.get_user_agent()
-        if user_agent:
+    def detect_os_mismatch(self, tcp_ip_fp, userAgentOS):
+        if userAgentOS:
             # get os by tcp ip fingerprint
             # Linux, macOS or Windows
             tcpip_os = {
@@ -82,46 +269,160 @@ class ZardaxtApiServer(BaseHTTPRequestHandler):
             }
             # get highest OS from TCP/IP fingerprint
             highestOS = max(tcpip_os, key=tcpip_os.get)
-            userAgentOS = 'win'
-            if 'Linux' in user_agent or 'Android' in user_agent:
-                userAgentOS = 'linux'
-            if 'Mac OS' in user_agent or 'iPhone' in user_agent:
-                userAgentOS = 'mac'
-
             return highestOS != userAgentOS
         else:
             return None
 
     def handle_lookup(self, client_ip, lookup_ip):
         detailed = self.get_query_arg('detail') is not None
-        fp_copy = self.fingerprints.copy()
-        fp_list = fp_copy.get(lookup_ip, None)
-        if fp_list and len(fp_list) > 0:
-            # return the newest fingerprint
-            fp_res = fp_list[-1]
-            classification = make_os_guess(fp_res)
-            classification['details']['num_fingerprints'] = len(fp_list)
-            classification['details']['lookup_ip'] = lookup_ip
-            classification['details']['client_ip'] = client_ip
-            classification['details']['os_mismatch'] = self.detect_os_mismatch(
-                classification)
-            if detailed:
-                return self.send_json(classification)
-            else:
-                return self.send_json({
-                    "os_mismatch": classification['details']['os_mismatch'],
-                    "lookup_ip": lookup_ip,
-                    "perfect_score": classification['details']["perfect_score"],
-                    "avg_score_os_class": classification["avg_score_os_class"]
-                })
+        try:
+            # wait this many ms for the SYN of the IP if it was not captured yet
+            wait = min(max(int(self.get_query_arg('wait') or 0), 0), self.max_wait)
+        except ValueError:
+            return self.send_body(400, bytes('Invalid parameter: wait', 'utf-8'), 'text/plain')
+        # the newest fingerprint
+        entry, num_syns = self.fingerprints.lookup(lookup_ip, timeout=wait / 1000)
+        if entry is not None:
+            user_agent_os = self.get_user_agent_os()
+            # the response only changes with a new SYN of the IP (or expired
+            # ones for num_fingerprints) or a reloaded database
+            key = (lookup_ip, client_ip, detailed, user_agent_os)
+            version = (entry.seq, num_syns, zardaxt_utils.database_generation)
+            cached = self.response_cache.get(key) if self.response_cache is not None else None
+            if cached is None or cached[0] != version:
+                body = encode_json(self.lookup_payload(
+                    entry, num_syns, client_ip, lookup_ip, detailed, user_agent_os),
+                    self.compact_json)
+                etag = '"{}-{:08x}"'.format(entry.seq, zlib.crc32(body))
+                cached = (version, body, etag)
+                if self.response_cache is not None:
+                    self.response_cache.put(key, cached)
+            return self.send_cached(cached[1], cached[2])
         else:
             msg = {
                 'lookup_ip': lookup_ip,
-                'msg': 'no fingerprint for this IP ({} fingerprints in memory)'.format(len(fp_copy)),
+                'msg': 'no fingerprint for this IP ({} fingerprints in memory)'.format(len(self.fingerprints)),
             }
             log(msg, 'api', onlyPrint=True)
             return self.send_json(msg)
 
+    def lookup_payload(self, entry, num_syns, client_ip, lookup_ip, detailed, user_agent_os,
+                       avg_os_score=None):
+        """The /classify response for the newest fingerprint entry of lookup_ip.
+
+        The fingerprint is scored unless avg_os_score is passed or the
+        classifier scored it already.
+        """
+        if avg_os_score is None:
+            # scored by the classifier already (classify_on_capture)?
+            avg_os_score = current_scores(entry.scores)
+        fp_res = entry.record.to_dict() if detailed or avg_os_score is None else None
+        classification = make_os_guess(fp_res, avg_os_score, self.scorer)
+        classification['details']['num_fingerprints'] = num_syns
+        classification['details']['lookup_ip'] = lookup_ip
+        classification['details']['client_ip'] = client_ip
+        classification['details']['os_mismatch'] = self.detect_os_mismatch(
+            classification, user_agent_os)
+        if detailed:
+            return classification
+        return {
+            "os_mismatch": classification['details']['os_mismatch'],
+            "lookup_ip": lookup_ip,
+            "perfect_score": classification['details']["perfect_score"],
+            "avg_score_os_class": classification["avg_score_os_class"]
+        }
+
+    def handle_batch_lookup(self, client_ip):
+        """Look up many IPs with one request.
+
+        The request body is a JSON object with a list of "lookups", either IPs
+        or {"ip": ..., "user_agent": ...} objects, and an optional "detail".
+        The response has the /classify response of every lookup, in order.
+        """
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            # the body cannot be read
+            self.close_connection = True
+            return self.send_body(400, bytes('Invalid Content-Length', 'utf-8'), 'text/plain')
+        if length > self.max_batch_size * MAX_LOOKUP_BYTES:
+            # the body is not read
+            self.close_connection = True
+            return self.send_body(413, bytes('Batch too large', 'utf-8'), 'text/plain')
+        try:
+            request = json.loads(self.rfile.read(length))
+            lookups = [{'ip': item} if isinstance(item, str) else item
+                       for item in request['lookups']]
+            for item in lookups:
+                if not isinstance(item['ip'], str):
+                    raise ValueError('ip must be a string: {!r}'.format(item['ip']))
+                if not isinstance(item.get('user_agent', ''), (str, type(None))):
+                    raise ValueError('user_agent must be a string')
+            lookups = [(item['ip'], user_agent_os(item.get('user_agent'))) for item in lookups]
+            detailed = bool(request.get('detail'))
+        except (ValueError, TypeError, KeyError, AttributeError) as err:
+            return self.send_body(400, bytes('Invalid batch: {}'.format(err), 'utf-8'),
+                                  'text/plain')
+        if len(lookups) > self.max_batch_size:
+            return self.send_body(413, bytes('At most {} lookups per batch'.format(
+                self.max_batch_size), 'utf-8'), 'text/plain')
+        found = [(ip, ua_os) + self.fingerprints.lookup(ip) for ip, ua_os in lookups]
+        # the fingerprints the classifier did not score yet, every signature is scored once
+        unscored = [entry for _, _, entry, _ in found
+                    if entry is not None and current_scores(entry.scores) is None]
+        scores = dict(zip(map(id, unscored), batch_os_scores(
+            [entry.record.to_dict() for entry in unscored], self.batch_scorer)))
+        results = []
+        for ip, ua_os, entry, num_syns in found:
+            if entry is None:
+                results.append({'lookup_ip': ip, 'msg': 'no fingerprint for this IP'})
+            else:
+                results.append(self.lookup_payload(entry, num_syns, client_ip, ip, detailed,
+                                                   ua_os, scores.get(id(entry))))
+        log('Batch lookup of {} IPs ({} scored)'.format(len(lookups), len(unscored)),
+            'api', onlyPrint=True)
+        return self.send_json({'results': results})
+
+    def handle_export(self):
+        """Stream the fingerprints as NDJSON, one IP per line.
+
+        Query parameters: cursor (the X-Next-Cursor of the previous
+        response, to page through or tail the store), since (unix time) and
+        limit (number of IPs).
+        """
+        try:
+            cursor = int(self.get_query_arg('cursor') or 0)
+            since = float(self.get_query_arg('since') or 0)
+            limit = self.get_query_arg('limit')
+            limit = int(limit) if limit else None
+            if limit is not None and limit < 1:
+                raise ValueError('limit must be positive')
+        except ValueError as err:
+            return self.send_body(400, bytes('Invalid parameter: {}'.format(err), 'utf-8'),
+                                  'text/plain')
+        next_cursor, changes = self.fingerprints.changes(cursor, since, limit)
+        self.send_stream(self.export_chunks(changes), 'application/x-ndjson',
+                         [('X-Next-Cursor', str(next_cursor))])
+
+    def export_chunks(self, changes):
+        lines = []
+        size = 0
+        for ip, seq, history in changes:
+            line = encode_json({
+                'ip': ip,
+                'seq': seq,
+                'fingerprints': [entry.to_dict() for entry in history],
+            }) + b'\n'
+            lines.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK_SIZE:
+                yield b''.join(lines)
+                lines = []
+                size = 0
+        yield b''.join(lines)
+
     def handle_authenticated_lookup(self, client_ip):
         lookup_ip = self.get_query_arg('ip')
         if lookup_ip:
@@ -129,7 +430,8 @@ class ZardaxtApiServer(BaseHTTPRequestHandler):
                 lookup_ip), 'api')
             self.handle_lookup(client_ip, lookup_ip)
         else:
-            return self.send_json(self.fingerprints.copy())
+            # the whole store, streamed like /all
+            return self.handle_export()
 
     def handle_lookup_by_client_ip(self, client_ip):
         log('No Api Key provided. Looking up client IP {}'.format(
@@ -151,30 +453,51 @@ class ZardaxtApiServer(BaseHTTPRequestHandler):
                     return self.handle_lookup_by_client_ip(client_ip)
             if self.path.startswith('/all'):
                 if key and self.config['api_key'] == key:
-                    fpCopy = self.fingerprints.copy()
-                    return self.send_json(fpCopy)
+                    return self.handle_export()
                 else:
-                    return self.deny(fpCopy)
+                    return self.deny()
             elif self.path.startswith('/stats'):
                 if key and self.config['api_key'] == key:
-                    fpCopy = self.fingerprints.copy()
+                    store_stats = self.fingerprints.stats()
                     return self.send_json({
-                        'numIPs': len(fpCopy),
-                        'numFingerprints': sum([len(value) for value in fpCopy.values()]),
+                        'numIPs': store_stats['ips'],
+                        'numFingerprints': store_stats['fingerprints'],
+                        'store': store_stats,
+                        'scoreCache': get_score_cache_stats(),
+                        'optionsCache': get_options_cache_stats(),
+                        'responseCache': self.response_cache.stats() if self.response_cache is not None else None,
+                        'metrics': get_metrics(),
                     })
             return self.deny()
         except Exception as e:
-            traceback_str = ''.join(traceback.format_tb(e.__traceback__))
-            msg = f'do_GET() failed: {e} with traceback {traceback_str}'
-            log(msg, 'api', level='ERROR')
+            return self.handle_failure('do_GET', e)
+
+    def do_POST(self):
+        client_ip = self.get_ip()
+        key = self.get_query_arg('key')
+
+        try:
+            if self.path.startswith('/classify') and key and self.config['api_key'] == key:
+                return self.handle_batch_lookup(client_ip)
+            # the request body was not read
+            self.close_connection = True
             return self.deny()
+        except Exception as e:
+            return self.handle_failure('do_POST', e)
 
 
-def create_server(config, fingerprints, timestamps):
+def create_server(config, fingerprints, timestamps, scoring_pool=None):
     try:
         server_address = (config['api_server_ip'], config['api_server_port'])
-        handler = ZardaxtApiServer(config, fingerprints, timestamps)
-        httpd = HTTPServerIPv6(server_address, handler)
+        handler = ZardaxtApiServer(config, fingerprints, timestamps, scoring_pool)
+        num_workers = config.get('api_workers', 16)
+        if num_workers > 0:
+            httpd = ThreadPoolHTTPServer(server_address, handler, num_workers,
+                                         config.get('api_max_pending', 64))
+        else:
+            # one request after the other, a kept alive connection would block all others
+            handler.protocol_version = 'HTTP/1.0'
+            httpd = HTTPServerIPv6(server_address, handler)
         log("TCP/IP Fingerprint (Zardaxt.py) API started on http://%s:%s" %
             server_address, 'api', level='INFO')
         httpd.serve_forever()
@@ -185,7 +508,7 @@ def create_server(config, fingerprints, timestamps):
             err, traceback.format_exc()), 'api', level='ERROR')
 
 
-def run_api(config, fingerprints, timestamps):
+def run_api(config, fingerprints, timestamps, scoring_pool=None):
     thread = _thread.start_new_thread(
-        create_server, (config, fingerprints, timestamps))
+        create_server, (config, fingerprints, timestamps, scoring_pool))
     return thread
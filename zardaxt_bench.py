@@ -0,0 +1,265 @@
+import sys
+import time
+import random
+import socket
+import multiprocessing
+import dpkt
+import pcapy
+from zardaxt_capture import capture_next, capture_dispatch, open_live
+from zardaxt_parser import fingerprint_from_dpkt, parse_syn
+from zardaxt_ring import TPacketV3Ring
+from zardaxt_tcp_options import decode_tcp_options, decode_tcp_options_raw
+
+"""
+Benchmarks for the capture path.
+
+Usage:
+
+python zardaxt_bench.py capture [file.pcap] [batch_size]
+python zardaxt_bench.py parser [file.pcap]
+python zardaxt_bench.py options [file.pcap]
+python zardaxt_bench.py backends [file.pcap] [interface]
+
+When no pcap file is given, a synthetic capture with a mix of
+client SYNs and other TCP segments is written to /tmp/zardaxt_bench.pcap.
+"""
+
+
+def make_tcp_frame(src, dst, sport, dport, flags, opts=b''):
+    tcp = dpkt.tcp.TCP(sport=sport, dport=dport, flags=flags,
+                       seq=random.getrandbits(32), opts=opts)
+    tcp.off = (20 + len(opts)) >> 2
+    ip = dpkt.ip.IP(src=src, dst=dst, p=dpkt.ip.IP_PROTO_TCP, ttl=64, data=tcp)
+    ip.len = len(ip)
+    return bytes(dpkt.ethernet.Ethernet(type=dpkt.ethernet.ETH_TYPE_IP, data=ip))
+
+
+def write_test_pcap(path, num_packets=200000, syn_ratio=0.1):
+    """Write a capture with num_packets TCP segments, syn_ratio of them client SYNs."""
+    syn_opts = b'\x02\x04\x05\xb4\x04\x02\x08\x0a\x00\x01\x02\x03\x00\x00\x00\x00\x01\x03\x03\x07'
+    with open(path, 'wb') as f:
+        writer = dpkt.pcap.Writer(f)
+        for i in range(num_packets):
+            src = random.getrandbits(32).to_bytes(4, 'big')
+            dst = b'\x0a\x00\x00\x01'
+            if random.random() < syn_ratio:
+                frame = make_tcp_frame(src, dst, random.randint(1024, 65535), 443,
+                                       dpkt.tcp.TH_SYN, syn_opts)
+            else:
+                frame = make_tcp_frame(src, dst, random.randint(1024, 65535), 443,
+                                       dpkt.tcp.TH_ACK)
+            writer.writepkt(frame, ts=1690000000 + i / 1000)
+    return path
+
+
+def count_syns(counter):
+    """The per packet work of the capture loop, without storing the fingerprint."""
+    def on_packet(header, buf):
+        eth = dpkt.ethernet.Ethernet(buf)
+        if eth.type == dpkt.ethernet.ETH_TYPE_IP or eth.type == dpkt.ethernet.ETH_TYPE_IP6:
+            tcp_pkt = eth.data.data
+            header.getlen()
+            header.getcaplen()
+            header.getts()
+            if hasattr(tcp_pkt, 'flags') and tcp_pkt.flags & dpkt.tcp.TH_SYN \
+                    and not tcp_pkt.flags & dpkt.tcp.TH_ACK:
+                counter[0] += 1
+    return on_packet
+
+
+def ignore_packet(counter):
+    """No per packet work at all, measures the overhead of the capture loop alone."""
+    def on_packet(header, buf):
+        pass
+    return on_packet
+
+
+def bench_capture_modes(pcap_path, batch_size=256, rounds=3, make_handler=count_syns):
+    """Compare the packet throughput of the next() and the dispatch() capture loop."""
+    results = {}
+    modes = [
+        ('next', lambda preader, cb: capture_next(preader, cb, stop_when_empty=True)),
+        ('dispatch', lambda preader, cb: capture_dispatch(
+            preader, cb, batch_size, stop_when_empty=True)),
+    ]
+    for name, capture in modes:
+        best = None
+        for _ in range(rounds):
+            syns = [0]
+            preader = pcapy.open_offline(pcap_path)
+            t0 = time.perf_counter()
+            num_packets = capture(preader, make_handler(syns))
+            elapsed = time.perf_counter() - t0
+            if best is None or elapsed < best[1]:
+                best = (num_packets, elapsed, syns[0])
+        num_packets, elapsed, syns = best
+        results[name] = round(num_packets / elapsed)
+        print('{:>8}: {} packets ({} SYNs) in {}ms, {} packets/s'.format(
+            name, num_packets, syns, round(elapsed * 1000, 1), results[name]))
+    print('dispatch/next throughput ratio: {}'.format(
+        round(results['dispatch'] / results['next'], 2)))
+    return results
+
+
+def read_frames(pcap_path):
+    frames = []
+    preader = pcapy.open_offline(pcap_path)
+    capture_next(preader, lambda header, buf: frames.append(
+        (header.getts(), header.getlen(), header.getcaplen(), buf)), stop_when_empty=True)
+    return frames
+
+
+def parse_dpkt(ts, header_len, cap_len, buf):
+    eth = dpkt.ethernet.Ethernet(buf)
+    if eth.type == dpkt.ethernet.ETH_TYPE_IP or eth.type == dpkt.ethernet.ETH_TYPE_IP6:
+        ip_version = 6 if eth.type == dpkt.ethernet.ETH_TYPE_IP6 else 4
+        return fingerprint_from_dpkt(ts, header_len, cap_len, eth.data, ip_version)
+
+
+def parse_raw(ts, header_len, cap_len, buf):
+    return parse_syn(buf, ts, header_len, cap_len)
+
+
+def bench_parsers(pcap_path, rounds=3):
+    """Compare the dpkt based and the raw bytes parsing of captured frames."""
+    frames = read_frames(pcap_path)
+    results = {}
+    for name, parse in [('dpkt', parse_dpkt), ('raw', parse_raw)]:
+        best = None
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            fps = [parse(*frame) for frame in frames]
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = fps
+        print('{:>5}: {} frames ({} SYNs) in {}ms, {} frames/s'.format(
+            name, len(frames), len([fp for fp in fps if fp]), round(best * 1000, 1),
+            round(len(frames) / best)))
+    print('identical fingerprints: {}'.format(results['dpkt'] == results['raw']))
+
+
+def bench_tcp_options(pcap_path, rounds=3):
+    """Compare decoding the TCP options of the SYNs with dpkt and from the raw bytes."""
+    options = []
+    for ts, header_len, cap_len, buf in read_frames(pcap_path):
+        fp = parse_raw(ts, header_len, cap_len, buf)
+        if fp:
+            eth = dpkt.ethernet.Ethernet(buf)
+            options.append(eth.data.data.opts)
+    results = {}
+    for name, decode in [('dpkt', lambda opts: decode_tcp_options(dpkt.tcp.parse_opts(opts))),
+                         ('raw', lambda opts: decode_tcp_options_raw(opts)[:5])]:
+        best = None
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            decoded = [decode(opts) for opts in options]
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = decoded
+        print('{:>5}: {} option lists in {}ms, {}us per SYN'.format(
+            name, len(options), round(best * 1000, 1), round(best / len(options) * 1e6, 2)))
+    print('identical options: {}'.format(results['dpkt'] == results['raw']))
+
+
+def capture_backend(name, interface, ready, stop, results):
+    """Capture with the pcapy or the tpacket_v3 backend until stop is set."""
+    counts = [0, 0]
+
+    def on_frame(ts, header_len, cap_len, buf):
+        counts[0] += 1
+        if parse_syn(buf, ts, header_len, cap_len):
+            counts[1] += 1
+
+    if name == 'pcapy':
+        preader = open_live(interface, {'read_timeout': 100})
+        preader.setfilter('')
+
+        def on_packet(header, buf):
+            on_frame(header.getts(), header.getlen(), header.getcaplen(), buf)
+        dispatch = lambda: preader.dispatch(-1, on_packet)
+    else:
+        ring = TPacketV3Ring(interface, '', {'read_timeout': 100})
+        dispatch = lambda: ring.dispatch(on_frame, 100)
+    ready.set()
+    t0 = time.process_time()
+    while not stop.is_set():
+        dispatch()
+    results.put((name, counts[0], counts[1], time.process_time() - t0))
+
+
+def bench_capture_backends(pcap_path, interface='lo', rate=50000):
+    """Compare the CPU time per packet of the pcapy and the tpacket_v3 backend.
+
+    Both backends capture concurrently on interface, while the frames of
+    pcap_path are replayed onto it with a packet socket at rate packets per
+    second, so they see exactly the same traffic. Needs root.
+    """
+    frames = [frame[3] for frame in read_frames(pcap_path)]
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    results = context.Queue()
+    workers = []
+    for name in ['pcapy', 'tpacket_v3']:
+        ready = context.Event()
+        worker = context.Process(target=capture_backend,
+                                 args=(name, interface, ready, stop, results))
+        worker.start()
+        ready.wait()
+        workers.append(worker)
+
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+    sock.bind((interface, 0))
+    t0 = time.perf_counter()
+    for i, frame in enumerate(frames):
+        sock.send(frame)
+        if i % 1000 == 999:
+            ahead = t0 + (i + 1) / rate - time.perf_counter()
+            if ahead > 0:
+                time.sleep(ahead)
+    elapsed = time.perf_counter() - t0
+    sock.close()
+    print('replayed {} frames on {} in {}ms'.format(
+        len(frames), interface, round(elapsed * 1000, 1)))
+    # let the backends drain what is buffered
+    time.sleep(1)
+    stop.set()
+    for _ in workers:
+        name, packets, syns, cpu = results.get()
+        print('{:>10}: {} packets ({} SYNs), {}s CPU, {}us CPU per packet'.format(
+            name, packets, syns, round(cpu, 3), round(cpu / max(packets, 1) * 1e6, 2)))
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'capture':
+        if len(sys.argv) >= 3:
+            pcap_path = sys.argv[2]
+        else:
+            pcap_path = write_test_pcap('/tmp/zardaxt_bench.pcap')
+        batch_size = int(sys.argv[3]) if len(sys.argv) >= 4 else 256
+        print('Capture loop with Ethernet/IP/TCP parsing:')
+        bench_capture_modes(pcap_path, batch_size)
+        print('Capture loop overhead only:')
+        bench_capture_modes(pcap_path, batch_size, make_handler=ignore_packet)
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'parser':
+        if len(sys.argv) >= 3:
+            pcap_path = sys.argv[2]
+        else:
+            pcap_path = write_test_pcap('/tmp/zardaxt_bench.pcap')
+        bench_parsers(pcap_path)
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'options':
+        if len(sys.argv) >= 3:
+            pcap_path = sys.argv[2]
+        else:
+            pcap_path = write_test_pcap('/tmp/zardaxt_bench.pcap')
+        bench_tcp_options(pcap_path)
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'backends':
+        if len(sys.argv) >= 3:
+            pcap_path = sys.argv[2]
+        else:
+            pcap_path = write_test_pcap('/tmp/zardaxt_bench.pcap')
+        interface = sys.argv[3] if len(sys.argv) >= 4 else 'lo'
+        bench_capture_backends(pcap_path, interface)
+    else:
+        print('Usage: python zardaxt_bench.py capture|parser|options|backends [file.pcap] [batch_size|interface]')
@@ -0,0 +1,236 @@
+import time
+from zardaxt_logging import log
+from zardaxt_metrics import set_metrics
+from zardaxt_filter import read_rx_packets
+
+try:
+    import pcapy
+except ImportError:
+    # only the AF_PACKET capture backends are available
+    pcapy = None
+
+"""
+Reading packets from the network interface.
+
+Two capture modes are supported:
+
+- next: calls preader.next() once per packet (the original capture loop)
+- dispatch: calls preader.dispatch(), which hands up to dispatch_batch_size
+  packets to the callback for a single wakeup of the capture loop
+"""
+
+# snaplen (maximum number of bytes to capture per packet)
+# 120 bytes are picked, since the maximum TCP header is 60 bytes and the maximum IP header is also 60 bytes
+# The IPv6 header is always present and is a fixed size of 40 bytes.
+MAX_BYTES = 120
+# the capture buffer size libpcap uses when none is set
+DEFAULT_BUFFER_SIZE = 2 * 1024 * 1024
+
+
+def open_live(interface, config, buffer_size=None):
+    # promiscuous mode (1 for true)
+    promiscuous = False
+    # https://github.com/the-tcpdump-group/libpcap/issues/572
+    # The main purpose of timeouts in packet capture mechanisms is to allow the capture mechanism
+    # to buffer up multiple packets, and deliver multiple packets in a single wakeup, rather than one
+    # wakeup per packet, reducing the number of wakeups (which aren't free),
+    # timeout (in milliseconds)
+    read_timeout = config.get('read_timeout', 1)
+    # size of the kernel capture buffer in bytes, 0 keeps the libpcap default
+    if buffer_size is None:
+        buffer_size = config.get('capture_buffer_size', 0)
+    # deliver every packet as soon as it arrives, instead of after read_timeout
+    immediate_mode = config.get('immediate_mode', False)
+
+    if pcapy is None:
+        raise Exception('pcapy is not installed, install pcapy-ng or use "capture_backend": "tpacket_v3"')
+
+    if not hasattr(pcapy, 'create'):
+        if buffer_size or immediate_mode:
+            log('capture_buffer_size and immediate_mode need pcapy-ng, ignoring them',
+                'zardaxt', level='ERROR')
+        # Read from the network interface in live mode
+        return pcapy.open_live(interface, MAX_BYTES, promiscuous, read_timeout)
+
+    preader = pcapy.create(interface)
+    preader.set_snaplen(MAX_BYTES)
+    preader.set_promisc(promiscuous)
+    preader.set_timeout(read_timeout)
+    if buffer_size:
+        preader.set_buffer_size(buffer_size)
+    if immediate_mode:
+        set_immediate_mode = getattr(preader, 'set_immediate_mode', None)
+        if set_immediate_mode is not None:
+            set_immediate_mode(1)
+        else:
+            log('immediate_mode is not supported by this pcapy version, packets '
+                'are delivered after read_timeout ({}ms)'.format(read_timeout), 'zardaxt', level='ERROR')
+    preader.activate()
+    return preader
+
+
+class CaptureStats(object):
+    """Periodically publishes the capture counters as 'capture' metrics.
+
+    received, dropped and if_dropped are the counters of preader.stats()
+    (summed up over reopened readers). filtered_out_packets estimates how
+    many packets the pcap filter kept from being copied to user space: the
+    packets received by the interface minus the packets that passed the filter.
+
+    With capture_buffer_autogrow (pcapy backend only), the reader is reopened with a twice
+    as large capture buffer whenever more than capture_drop_threshold packets
+    were dropped since the last report, up to capture_buffer_max_size.
+
+    maybe_report() is called from the capture loop, so the counters are
+    only refreshed while packets are being captured.
+    """
+
+    def __init__(self, preader, interface, config, pcap_filter=''):
+        self.preader = preader
+        self.interface = interface
+        self.config = config
+        self.pcap_filter = pcap_filter
+        self.interval = config.get('stats_interval', 60)
+        self.buffer_size = getattr(preader, 'buffer_size', None) or \
+            config.get('capture_buffer_size', 0) or DEFAULT_BUFFER_SIZE
+        self.autogrow = config.get('capture_buffer_autogrow', False) and \
+            config.get('capture_backend', 'pcapy') == 'pcapy'
+        self.drop_threshold = config.get('capture_drop_threshold', 1000)
+        self.max_buffer_size = config.get('capture_buffer_max_size', 256 * 1024 * 1024)
+        # counters of the readers closed by autogrow
+        self.closed_counters = (0, 0, 0)
+        self.last_dropped = 0
+        self.rx_start = read_rx_packets(interface)
+        self.next_report = time.time() + self.interval
+
+    def maybe_report(self):
+        """Returns:
+            The new reader if the capture buffer was grown, else None
+        """
+        now = time.time()
+        if now < self.next_report:
+            return None
+        self.next_report = now + self.interval
+        values = self.report()
+        dropped = values['dropped'] + values['if_dropped']
+        new_drops = dropped - self.last_dropped
+        self.last_dropped = dropped
+        if self.autogrow and new_drops > self.drop_threshold and self.buffer_size < self.max_buffer_size:
+            return self.grow_buffer()
+        return None
+
+    def report(self):
+        recv, drop, ifdrop = [closed + current for closed, current in zip(
+            self.closed_counters, self.preader.stats())]
+        values = {
+            'received': recv,
+            'dropped': drop,
+            'if_dropped': ifdrop,
+            'buffer_size': self.buffer_size,
+        }
+        rx_packets = read_rx_packets(self.interface)
+        if rx_packets is not None and self.rx_start is not None:
+            values['interface_rx_packets'] = rx_packets - self.rx_start
+            values['filtered_out_packets'] = max(
+                0, values['interface_rx_packets'] - recv)
+        set_metrics('capture', values)
+        log('capture stats: {}'.format(values), 'zardaxt')
+        return values
+
+    def grow_buffer(self):
+        buffer_size = min(self.buffer_size * 2, self.max_buffer_size)
+        log('Packets are being dropped, reopening {} with a capture buffer of {} bytes'.format(
+            self.interface, buffer_size), 'zardaxt', level='ERROR')
+        # open the new reader before closing the old one, so that as few packets as possible are lost
+        preader = open_live(self.interface, self.config, buffer_size)
+        preader.setfilter(self.pcap_filter)
+        self.closed_counters = tuple(closed + current for closed, current in zip(
+            self.closed_counters, self.preader.stats()))
+        self.preader.close()
+        self.preader = preader
+        self.buffer_size = buffer_size
+        return preader
+
+
+def capture_next(preader, on_packet, stop_when_empty=False, periodic=None):
+    """Read one packet per call to preader.next().
+
+    Args:
+        preader: The pcapy reader
+        on_packet (function): Called with (header, buf) for each packet
+        stop_when_empty (bool): Return when no packet is read, e.g. at
+            the end of an offline capture
+        periodic (function): Called after every read, must be cheap. When it
+            returns a reader, the capture continues with that reader
+
+    Returns:
+        int: The number of packets read
+    """
+    num_packets = 0
+    while True:
+        (header, buf) = preader.next()
+        if periodic is not None:
+            preader = periodic() or preader
+        if header is None:
+            # read timeout without packets or end of an offline capture
+            if stop_when_empty:
+                break
+            continue
+        on_packet(header, buf)
+        num_packets += 1
+    return num_packets
+
+
+def capture_dispatch(preader, on_packet, batch_size=256, stop_when_empty=False, periodic=None):
+    """Drain up to batch_size packets per call to preader.dispatch().
+
+    libpcap invokes on_packet for every packet of the buffer it received
+    in a single wakeup, so the Python loop runs once per batch instead
+    of once per packet.
+
+    Args:
+        preader: The pcapy reader
+        on_packet (function): Called with (header, buf) for each packet
+        batch_size (int): Maximum number of packets per dispatch() call,
+            -1 drains everything the kernel has buffered
+        stop_when_empty (bool): Return when no packet is read, e.g. at
+            the end of an offline capture
+        periodic (function): Called after every dispatch() call, must be cheap.
+            When it returns a reader, the capture continues with that reader
+
+    Returns:
+        int: The number of packets read (only returns with stop_when_empty)
+    """
+    if not stop_when_empty:
+        while True:
+            preader.dispatch(batch_size, on_packet)
+            if periodic is not None:
+                preader = periodic() or preader
+
+    # The return value of dispatch() is not reliable across pcapy versions,
+    # therefore the delivered packets are counted
+    num_packets = [0]
+
+    def counting_on_packet(header, buf):
+        num_packets[0] += 1
+        on_packet(header, buf)
+
+    while True:
+        before = num_packets[0]
+        preader.dispatch(batch_size, counting_on_packet)
+        if num_packets[0] == before:
+            break
+    return num_packets[0]
+
+
+def run_capture(preader, config, on_packet, periodic=None):
+    mode = config.get('capture_mode', 'dispatch')
+    if mode == 'dispatch':
+        batch_size = config.get('dispatch_batch_size', 256)
+        log('Capturing with dispatch(), batch size {}'.format(batch_size), 'zardaxt')
+        return capture_dispatch(preader, on_packet, batch_size, periodic=periodic)
+    elif mode == 'next':
+        log('Capturing with next()', 'zardaxt')
+        return capture_next(preader, on_packet, periodic=periodic)
+    else:
+        raise Exception('Unknown capture_mode: {}'.format(mode))
@@ -0,0 +1,93 @@
+import time
+import queue
+import threading
+import traceback
+from zardaxt_logging import log
+from zardaxt_metrics import set_metrics
+from zardaxt_queue import BoundedQueue
+from zardaxt_utils import classify_fp
+
+"""
+Classification of the fingerprints as they are captured.
+
+Without it, /classify scores the newest fingerprint of an IP while the
+client waits. With classify_on_capture, every fingerprint added to the
+store is also queued for a background thread, which scores it and
+attaches the scores to the stored entry (see FingerprintStore.set_scores()).
+A lookup then only reads the scores. It still scores the fingerprint
+itself if it arrived before the classifier got to it.
+
+The queue drops the oldest fingerprints when it is full, those are
+probably outdated by newer fingerprints of the same IP anyway.
+
+Fingerprints already in the store when the classifier is started (restored
+by zardaxt_persist.py) are classified first, the newest one of every IP.
+"""
+
+
+class Classifier(object):
+    def __init__(self, config, store):
+        self.store = store
+        self.stats_interval = config.get('stats_interval', 60)
+        self.pending = BoundedQueue(config.get('classifier_queue_size', 10000), 'drop_oldest')
+        self.thread = None
+        self.counters = {
+            'classified': 0,
+            # a newer fingerprint of the IP was added before the classification
+            'outdated': 0,
+            'failed': 0,
+            # fingerprints that were in the store when the classifier was started
+            'stored': 0,
+            'last_delay_ms': None,
+        }
+
+    def on_add(self, seq, added, fp):
+        """Store listener, called for every added fingerprint (under the store lock)."""
+        self.pending.put((seq, added, fp))
+
+    def start(self):
+        self.store.add_listener(self.on_add)
+        self.thread = threading.Thread(target=self.run, name='zardaxt-classifier', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        self.classify_stored()
+        next_report = time.time() + self.stats_interval
+        while True:
+            try:
+                self.classify(*self.pending.get(timeout=1))
+            except queue.Empty:
+                pass
+            except Exception as err:
+                self.counters['failed'] += 1
+                log('classifier failed with error: {} and stack: {}'.format(
+                    err, traceback.format_exc()), 'classifier', level='ERROR')
+            if time.time() >= next_report:
+                next_report = time.time() + self.stats_interval
+                self.report()
+
+    def classify_stored(self):
+        try:
+            _, changes = self.store.changes()
+            for ip, seq, history in changes:
+                entry = history[-1]
+                if self.store.set_scores(ip, seq, classify_fp(entry.to_dict())):
+                    self.counters['stored'] += 1
+        except Exception as err:
+            log('classifying the stored fingerprints failed with error: {} and stack: {}'.format(
+                err, traceback.format_exc()), 'classifier', level='ERROR')
+        log('Classified {} stored fingerprints'.format(self.counters['stored']), 'classifier')
+
+    def classify(self, seq, added, fp):
+        scores = classify_fp(fp)
+        if self.store.set_scores(fp['src_ip'], seq, scores):
+            self.counters['classified'] += 1
+            self.counters['last_delay_ms'] = round((time.time() - added) * 1000, 2)
+        else:
+            self.counters['outdated'] += 1
+
+    def report(self):
+        values = dict(self.counters)
+        values['queue'] = self.pending.stats()
+        set_metrics('classifier', values)
+        return values
@@ -0,0 +1,191 @@
+import os
+import queue
+import signal
+import socket
+import struct
+import time
+import traceback
+import multiprocessing
+from zardaxt_logging import log
+from zardaxt_metrics import set_metrics
+from zardaxt_afpacket import open_socket, attach_filter, join_fanout, \
+    read_packet_statistics, SO_TIMESTAMP
+from zardaxt_capture import MAX_BYTES
+from zardaxt_parser import parse_syn
+
+"""
+Multi-process capture with PACKET_FANOUT.
+
+capture_workers processes each open an AF_PACKET socket on the interface
+and join the same fanout group. The kernel distributes the packets between
+them (by default by source address, so all SYNs of a client land on the
+same worker). Every worker parses its share of packets and sends the
+fingerprints of client SYNs to the main process, which stores them in the
+fingerprint store read by the API.
+
+The workers are forked by start(), before any other thread of the main
+process runs, so that no worker inherits a lock held by some thread (e.g.
+of the TCP option cache or the logger). capture_spare_workers spares are
+forked at the same time. A spare waits until it replaces a worker that
+exited, only then it opens its socket and joins the fanout group. Without
+spares left, the remaining workers capture all packets of the group.
+"""
+
+TIMEVAL = struct.Struct('@ll')
+
+
+def capture_worker(worker_id, interface, pcap_filter, group_id, num_workers,
+                   fanout_mode, buffer_size, fp_queue, counters, activate=None):
+    # the signal handlers of the main process write fingerprints.json
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTSTP, signal.SIG_DFL)
+    try:
+        if activate is not None:
+            # a spare, waits for the id of the worker it replaces
+            worker_id = activate.recv()
+            activate.close()
+        sock = open_socket(interface)
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMP, 1)
+        if buffer_size:
+            # capped by net.core.rmem_max
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        if not attach_filter(sock, pcap_filter) and pcap_filter:
+            log('capture worker {}: cannot compile the pcap filter without pcapy, '
+                'capturing unfiltered'.format(worker_id), 'fanout', level='ERROR')
+        join_fanout(sock, group_id, num_workers, fanout_mode)
+
+        buf = bytearray(MAX_BYTES)
+        view = memoryview(buf)
+        ancbufsize = socket.CMSG_SPACE(TIMEVAL.size)
+        packets = 0
+        syns = 0
+        dropped = 0
+        kernel_dropped = 0
+        while True:
+            # MSG_TRUNC returns the length of the whole packet, while only
+            # MAX_BYTES are copied to user space
+            header_len, ancdata, _, _ = sock.recvmsg_into(
+                [buf], ancbufsize, socket.MSG_TRUNC)
+            cap_len = min(header_len, MAX_BYTES)
+            ts = None
+            for level, kind, data in ancdata:
+                if level == socket.SOL_SOCKET and kind == SO_TIMESTAMP:
+                    ts = TIMEVAL.unpack(data[:TIMEVAL.size])
+            if ts is None:
+                now = time.time()
+                ts = (int(now), int((now % 1) * 1000000))
+            packets += 1
+            fp = parse_syn(view[:cap_len], ts, header_len, cap_len)
+            if fp:
+                syns += 1
+                try:
+                    fp_queue.put_nowait(fp)
+                except queue.Full:
+                    # never block the capture when the main process falls behind
+                    dropped += 1
+            if packets & 0xFF == 0:
+                kernel_dropped += read_packet_statistics(sock)[1]
+                counters[4 * worker_id + 3] = kernel_dropped
+            if packets & 0xFF == 0 or fp:
+                counters[4 * worker_id] = packets
+                counters[4 * worker_id + 1] = syns
+                counters[4 * worker_id + 2] = dropped
+    except Exception as err:
+        log("capture worker {} crashed with error: {} and stack: {}".format(
+            worker_id, err, traceback.format_exc()), 'fanout', level='ERROR')
+
+
+class FanoutCapture(object):
+    def __init__(self, config, interface, pcap_filter):
+        self.interface = interface
+        self.pcap_filter = pcap_filter
+        self.num_workers = config.get('capture_workers', 2)
+        self.fanout_mode = config.get('fanout_mode', 'source')
+        self.group_id = config.get('fanout_group_id', os.getpid() & 0xFFFF)
+        self.stats_interval = config.get('stats_interval', 60)
+        self.buffer_size = config.get('capture_buffer_size', 0)
+        # fork, so that the workers do not have to import and configure everything again
+        self.context = multiprocessing.get_context('fork')
+        self.fp_queue = self.context.Queue(config.get('fanout_queue_size', 100000))
+        # packets, SYNs, dropped fingerprints and packets dropped by the kernel per worker
+        self.counters = self.context.Array('Q', 4 * self.num_workers, lock=False)
+        self.num_spares = config.get('capture_spare_workers', 1)
+        # None once a worker exited without a spare left to replace it
+        self.workers = [None] * self.num_workers
+        # (process, the pipe end to send it the id of the worker it replaces)
+        self.spares = []
+        self.restarts = 0
+
+    def start(self):
+        """Fork the workers and the spares, call before other threads are started."""
+        log('Starting {} capture workers and {} spares in fanout group {} ({})'.format(
+            self.num_workers, self.num_spares, self.group_id, self.fanout_mode), 'fanout')
+        for worker_id in range(self.num_workers):
+            self.workers[worker_id] = self.fork_worker(worker_id)
+        for i in range(self.num_spares):
+            receiver, sender = self.context.Pipe(duplex=False)
+            spare = self.fork_worker(None, receiver, 'zardaxt-capture-spare-{}'.format(i))
+            receiver.close()
+            self.spares.append((spare, sender))
+
+    def fork_worker(self, worker_id, activate=None, name=None):
+        worker = self.context.Process(
+            target=capture_worker, name=name or 'zardaxt-capture-{}'.format(worker_id),
+            args=(worker_id, self.interface, self.pcap_filter, self.group_id,
+                  self.num_workers, self.fanout_mode, self.buffer_size,
+                  self.fp_queue, self.counters, activate),
+            daemon=True)
+        worker.start()
+        return worker
+
+    def check_workers(self):
+        for worker_id, worker in enumerate(self.workers):
+            if worker is not None and not worker.is_alive():
+                log('capture worker {} exited with code {}'.format(
+                    worker_id, worker.exitcode), 'fanout', level='ERROR')
+                self.workers[worker_id] = self.replace_worker(worker_id)
+                if self.workers[worker_id] is None:
+                    log('No spare capture worker left, capturing with {} workers from now on'.format(
+                        sum(worker is not None for worker in self.workers)), 'fanout', level='ERROR')
+
+    def replace_worker(self, worker_id):
+        """Hand the share of the exited worker to a spare, forking now is not safe."""
+        while self.spares:
+            spare, sender = self.spares.pop(0)
+            try:
+                sender.send(worker_id)
+            except OSError:
+                # the spare exited as well
+                continue
+            finally:
+                sender.close()
+            self.restarts += 1
+            return spare
+        return None
+
+    def report(self):
+        values = {
+            'workers': sum(worker is not None for worker in self.workers),
+            'spare_workers': len(self.spares),
+            'fanout_mode': self.fanout_mode,
+            'restarts': self.restarts,
+            'packets': [self.counters[4 * i] for i in range(self.num_workers)],
+            'syns': [self.counters[4 * i + 1] for i in range(self.num_workers)],
+            'dropped': [self.counters[4 * i + 2] for i in range(self.num_workers)],
+            'kernel_dropped': [self.counters[4 * i + 3] for i in range(self.num_workers)],
+        }
+        set_metrics('fanout', values)
+        return values
+
+    def run(self, on_fingerprint):
+        """Pass the fingerprints the workers send to on_fingerprint, after start()."""
+        next_report = time.time() + self.stats_interval
+        while True:
+            try:
+                on_fingerprint(self.fp_queue.get(timeout=1))
+            except queue.Empty:
+                pass
+            if time.time() >= next_report:
+                next_report = time.time() + self.stats_interval
+                self.check_workers()
+                self.report()
@@ -0,0 +1,126 @@
+import socket
+from zardaxt_logging import log
+
+"""
+Generate a BPF filter that only matches client SYN packets.
+
+The kernel then only copies the packets that are actually fingerprinted
+to user space, instead of every TCP and UDP packet.
+"""
+
+# SYN set, ACK not set
+SYN_ONLY_IPV4 = 'tcp[tcpflags] & (tcp-syn|tcp-ack) == tcp-syn'
+# libpcap cannot index into the TCP header of IPv6 packets (tcp[] is IPv4 only).
+# Therefore only IPv6 packets whose next header is TCP (no extension headers)
+# are matched, the TCP flags are at offset 40 + 13 of the IPv6 header.
+SYN_ONLY_IPV6 = 'ip6[6] == 6 and ip6[53] & 0x12 == 0x02'
+
+# /proc/net/tcp socket state
+TCP_LISTEN = '0A'
+
+
+def parse_proc_net_address(hex_address):
+    """Parse an address of /proc/net/tcp{,6} such as 0100007F:1F90.
+
+    The address is printed as 32 bit words in host byte order.
+
+    Returns:
+        (str, int): The IP address and the port
+    """
+    hex_ip, hex_port = hex_address.split(':')
+    raw = bytes.fromhex(hex_ip)
+    ip_bytes = b''.join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4))
+    family = socket.AF_INET if len(ip_bytes) == 4 else socket.AF_INET6
+    return socket.inet_ntop(family, ip_bytes), int(hex_port, 16)
+
+
+def get_listening_sockets(paths=('/proc/net/tcp', '/proc/net/tcp6')):
+    """
+    Returns:
+        list: The (ip, port) pairs of all listening TCP sockets
+    """
+    sockets = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            parts = line.split()
+            if len(parts) > 3 and parts[3] == TCP_LISTEN:
+                sockets.append(parse_proc_net_address(parts[1]))
+    return sockets
+
+
+def is_loopback(ip):
+    return ip == '::1' or ip.startswith('127.') or ip.startswith('::ffff:127.')
+
+
+def get_listening_ports(config):
+    """The TCP ports clients can connect to.
+
+    Sockets only listening on the loopback interface (such as the API
+    behind nginx) are ignored, since no external client can send a SYN to them.
+    """
+    if config.get('filter_ports'):
+        return sorted(set(config['filter_ports']))
+    ports = set()
+    for ip, port in get_listening_sockets():
+        if not is_loopback(ip):
+            ports.add(port)
+    return sorted(ports)
+
+
+def build_syn_filter(ports=None, addresses=None):
+    """Build a BPF filter expression matching SYN && !ACK for IPv4 and IPv6.
+
+    Args:
+        ports (list): Only match SYNs to those destination ports
+        addresses (list): Only match SYNs to those destination addresses
+
+    Returns:
+        str: The filter expression
+    """
+    expression = '(({}) or ({}))'.format(SYN_ONLY_IPV4, SYN_ONLY_IPV6)
+    if ports:
+        expression += ' and ({})'.format(
+            ' or '.join('tcp dst port {}'.format(port) for port in ports))
+    if addresses:
+        expression += ' and ({})'.format(
+            ' or '.join('dst host {}'.format(ip) for ip in addresses))
+    return expression
+
+
+def get_pcap_filter(config, local_addresses=None):
+    """The pcap filter to use.
+
+    With "pcap_filter": "auto" a SYN only filter is generated, optionally
+    restricted to the listening ports (filter_local_ports) and the
+    addresses of the capture interface (filter_local_addresses).
+
+    Args:
+        config (dict): The config
+        local_addresses (list): The addresses of the capture interface
+    """
+    pcap_filter = config.get('pcap_filter', '')
+    if pcap_filter != 'auto':
+        return pcap_filter
+    ports = None
+    addresses = None
+    if config.get('filter_local_ports', False):
+        ports = get_listening_ports(config)
+    if config.get('filter_local_addresses', False):
+        addresses = local_addresses
+    pcap_filter = build_syn_filter(ports, addresses)
+    log('Generated pcap filter: {}'.format(pcap_filter), 'zardaxt')
+    return pcap_filter
+
+
+def read_rx_packets(interface):
+    """The number of packets received by the interface, as counted by the kernel."""
+    try:
+        with open('/sys/class/net/{}/statistics/rx_packets'.format(interface)) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
@@ -1,13 +1,258 @@
 # why use pythons own module it sucks
+import os
+import sys
+import time
+import queue
+import atexit
+import threading
 from datetime import datetime
+from zardaxt_metrics import set_metrics
+from zardaxt_queue import BoundedQueue
 
+"""
+Logging to log/zardaxt.log, log/zardaxt.err (errors only) and stdout.
 
-def log(msg, module, onlyPrint=False, level='INFO'):
-    msg = f'[{datetime.now()}] - {level} - {module} - {msg}'
-    print(msg)
-    if onlyPrint is False:
-        with open('log/zardaxt.log', 'a') as logfile:
-            logfile.write(msg + '\n')
-        if level == 'ERROR':
-            with open('log/zardaxt.err', 'a') as logfile:
-                logfile.write(msg + '\n')
+log() only puts the message into a queue. A background thread formats
+and writes the queued messages in batches and flushes the log files every
+log_flush_interval seconds, so logging a SYN costs no syscall on the
+capture path. The log files are rotated when they reach log_max_bytes,
+log_backup_count old files (zardaxt.log.1, ...) are kept.
+
+Every message category (by default the module and level) is limited to
+log_rate_limit messages per second. The number of suppressed messages is
+logged once per flush interval instead. Write errors (e.g. a full disk)
+are counted and never raised to the caller.
+
+Call configure_logging(config) once the config is loaded, messages logged
+before use the defaults.
+"""
+
+LOG_FILE = 'zardaxt.log'
+ERR_FILE = 'zardaxt.err'
+
+
+class AsyncLogger(object):
+    def __init__(self, config=None):
+        config = config or {}
+        self.config = config
+        self.directory = config.get('log_dir', 'log')
+        self.max_bytes = config.get('log_max_bytes', 10 * 1024 * 1024)
+        self.backup_count = config.get('log_backup_count', 5)
+        self.rate_limit = config.get('log_rate_limit', 100)
+        self.flush_interval = config.get('log_flush_interval', 1)
+        self.stdout = config.get('log_stdout', True)
+        self.pending = BoundedQueue(config.get('log_queue_size', 10000), 'drop_newest')
+        # category -> [tokens, last update, suppressed messages]
+        self.buckets = {}
+        self.lock = threading.Lock()
+        # the open log files, only used with file_lock held
+        self.files = {}
+        # the (approximate) size of the open log files
+        self.sizes = {}
+        self.file_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.counters = {
+            'logged': 0,
+            'suppressed': 0,
+            'write_errors': 0,
+            'rotations': 0,
+        }
+
+    def log(self, msg, module, onlyPrint=False, level='INFO', category=None):
+        now = time.time()
+        if self.rate_limit and not self.allow(category or (module, level), now):
+            return
+        if self.thread is None:
+            self.start()
+        self.pending.put((now, level, module, msg, onlyPrint))
+
+    def allow(self, category, now):
+        """Token bucket of the category, refilled with rate_limit tokens per second."""
+        with self.lock:
+            bucket = self.buckets.get(category)
+            if bucket is None:
+                bucket = self.buckets[category] = [self.rate_limit, now, 0]
+            tokens = min(self.rate_limit, bucket[0] + (now - bucket[1]) * self.rate_limit)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                self.counters['suppressed'] += 1
+                return False
+            bucket[0] = tokens - 1
+            return True
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name='zardaxt-log', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        next_flush = time.time() + self.flush_interval
+        while not self.stopped.is_set():
+            self.write(self.take_batch(timeout=self.flush_interval))
+            if time.time() >= next_flush:
+                next_flush = time.time() + self.flush_interval
+                self.write_suppressed()
+                self.flush()
+                set_metrics('logging', self.stats())
+
+    def take_batch(self, timeout, max_items=1000):
+        try:
+            batch = [self.pending.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < max_items:
+            try:
+                batch.append(self.pending.get(timeout=0))
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch):
+        if not batch:
+            return
+        printed = []
+        lines = []
+        errors = []
+        for ts, level, module, msg, only_print in batch:
+            line = f'[{datetime.fromtimestamp(ts)}] - {level} - {module} - {msg}\n'
+            printed.append(line)
+            if only_print is False:
+                lines.append(line)
+                if level == 'ERROR':
+                    errors.append(line)
+        self.counters['logged'] += len(batch)
+        if self.stdout:
+            try:
+                sys.stdout.write(''.join(printed))
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                pass
+        with self.file_lock:
+            self.write_file(LOG_FILE, lines)
+            self.write_file(ERR_FILE, errors)
+
+    def write_suppressed(self):
+        with self.lock:
+            suppressed = [(category, bucket[2]) for category, bucket in self.buckets.items()
+                          if bucket[2]]
+            for category, _ in suppressed:
+                self.buckets[category][2] = 0
+        now = time.time()
+        self.write([(now, 'INFO', 'logging', 'Suppressed {} messages of {}'.format(
+            count, category if isinstance(category, str) else '{} {}'.format(*category)), False)
+            for category, count in suppressed])
+
+    def write_file(self, name, lines):
+        if not lines:
+            return
+        try:
+            logfile = self.files.get(name)
+            if logfile is None:
+                path = os.path.join(self.directory, name)
+                logfile = self.files[name] = open(path, 'a')
+                self.sizes[name] = os.path.getsize(path)
+            data = ''.join(lines)
+            logfile.write(data)
+            self.sizes[name] += len(data)
+            if self.max_bytes and self.sizes[name] >= self.max_bytes:
+                self.rotate(name)
+        except OSError:
+            # a full disk must not crash zardaxt, drop the lines and reopen the file later
+            self.counters['write_errors'] += 1
+            self.close_file(name)
+
+    def rotate(self, name):
+        """zardaxt.log -> zardaxt.log.1 -> ... -> zardaxt.log.<backup_count>"""
+        self.close_file(name)
+        path = os.path.join(self.directory, name)
+        if self.backup_count:
+            for i in range(self.backup_count - 1, 0, -1):
+                if os.path.exists('{}.{}'.format(path, i)):
+                    os.replace('{}.{}'.format(path, i), '{}.{}'.format(path, i + 1))
+            os.replace(path, path + '.1')
+        else:
+            os.remove(path)
+        self.counters['rotations'] += 1
+
+    def close_file(self, name):
+        logfile = self.files.pop(name, None)
+        if logfile is not None:
+            try:
+                logfile.close()
+            except OSError:
+                pass
+
+    def flush(self):
+        with self.file_lock:
+            self.flush_files()
+
+    def flush_files(self):
+        for name in list(self.files):
+            try:
+                self.files[name].flush()
+            except OSError:
+                self.counters['write_errors'] += 1
+                self.close_file(name)
+
+    def close(self, timeout=5):
+        """Write all queued messages and close the log files."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        while len(self.pending):
+            self.write(self.take_batch(timeout=0))
+        self.write_suppressed()
+        with self.file_lock:
+            for name in list(self.files):
+                self.close_file(name)
+
+    def stats(self):
+        values = dict(self.counters)
+        values['pending'] = len(self.pending)
+        values['dropped'] = self.pending.dropped
+        return values
+
+
+logger = AsyncLogger()
+
+
+def configure_logging(config):
+    global logger
+    previous = logger
+    logger = AsyncLogger(config)
+    previous.close()
+
+
+def log(msg, module, onlyPrint=False, level='INFO', category=None):
+    logger.log(msg, module, onlyPrint, level, category)
+
+
+def shutdown():
+    logger.close()
+
+
+def before_fork():
+    # flush, so that the child does not write the buffered lines again
+    logger.file_lock.acquire()
+    logger.flush_files()
+
+
+def after_fork_in_parent():
+    logger.file_lock.release()
+
+
+def after_fork_in_child():
+    # The writer thread does not exist in a forked child (the fanout
+    # capture workers), the child starts a logger of its own.
+    global logger
+    logger = AsyncLogger(logger.config)
+
+
+atexit.register(shutdown)
+os.register_at_fork(before=before_fork, after_in_parent=after_fork_in_parent,
+                    after_in_child=after_fork_in_child)
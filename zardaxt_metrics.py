@@ -0,0 +1,21 @@
+import threading
+
+"""
+Runtime metrics, grouped by subsystem (capture, ...).
+
+Producers replace the values of their group with set_metrics(),
+the API reports all groups with get_metrics().
+"""
+
+metrics = {}
+metrics_lock = threading.Lock()
+
+
+def set_metrics(group, values):
+    with metrics_lock:
+        metrics[group] = dict(values)
+
+
+def get_metrics():
+    with metrics_lock:
+        return {group: dict(values) for group, values in metrics.items()}
@@ -0,0 +1,127 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Vectorized TCP/IP fingerprint scoring with NumPy.
+
+The database is encoded once into integer coded columns (one column per
+scored field) plus a per entry OS index. Scoring a fingerprint (or a whole
+matrix of fingerprints) is then a vectorized equality check, a multiplication
+with the field weights and a np.bincount() per OS class.
+
+The results are identical to zardaxt_utils.score_fp(). NumPy is optional,
+this module is only used when the config selects "scoring_backend": "numpy"
+or when scoring large batches offline.
+"""
+
+# Unknown values are encoded with this code. It never matches a database column.
+UNKNOWN_CODE = -1
+
+
+class NumpyScorer(object):
+    def __init__(self, entries, field_weights, os_classes,
+                 tcp_options_weight=4, tcp_options_ordered_weight=2.5,
+                 max_cells=8000000):
+        """
+        Args:
+            entries (list): The database entries
+            field_weights (list): (field, weight) pairs, without tcp_options
+                and tcp_options_ordered
+            os_classes (list): The OS classes in output order
+            max_cells (int): Upper bound for the size of the intermediate
+                fingerprints x entries x fields comparison in score_many()
+        """
+        if np is None:
+            raise Exception('The numpy scoring backend requires numpy')
+
+        self.fields = [field for field, _ in field_weights] + \
+            ['tcp_options', 'tcp_options_ordered']
+        self.weights = np.array([weight for _, weight in field_weights],
+                                dtype=np.float64)
+        self.tcp_options_weight = tcp_options_weight
+        self.tcp_options_ordered_weight = tcp_options_ordered_weight
+        self.os_classes = list(os_classes)
+        self.max_cells = max_cells
+
+        os_index = {os_name: i for i, os_name in enumerate(self.os_classes)}
+        self.codes = [{} for _ in self.fields]
+        columns = np.empty((len(entries), len(self.fields)), dtype=np.int64)
+        for row, entry in enumerate(entries):
+            for col, field in enumerate(self.fields):
+                columns[row, col] = self.codes[col].setdefault(
+                    entry[field], len(self.codes[col]))
+        self.columns = columns
+        self.entry_os = np.array([os_index[entry['os']] for entry in entries],
+                                 dtype=np.int64)
+        self.os_sample_count = np.bincount(
+            self.entry_os, minlength=len(self.os_classes))
+
+    def encode(self, fps):
+        """Encode fingerprint dicts into a (len(fps), fields) code matrix."""
+        matrix = np.empty((len(fps), len(self.fields)), dtype=np.int64)
+        for row, fp in enumerate(fps):
+            for col, field in enumerate(self.fields):
+                matrix[row, col] = self.codes[col].get(fp[field], UNKNOWN_CODE)
+        return matrix
+
+    def _entry_scores(self, matrix):
+        """Returns the (fingerprints, entries) score matrix."""
+        n_weights = len(self.weights)
+        equal = matrix[:, None, :] == self.columns[None, :, :]
+        scores = equal[:, :, :n_weights] @ self.weights
+        options = equal[:, :, n_weights]
+        ordered = equal[:, :, n_weights + 1]
+        scores += options * self.tcp_options_weight
+        scores += (ordered & ~options) * self.tcp_options_ordered_weight
+        return scores
+
+    def _avg_os_scores(self, os_scores):
+        avg_os_score = {}
+        for i, os_name in enumerate(self.os_classes):
+            avg_os_score[os_name] = round(
+                float(os_scores[i]) / int(self.os_sample_count[i]), 2)
+        return avg_os_score
+
+    def score(self, fp):
+        """Score a single (normalized) fingerprint.
+
+        Returns:
+            avg_os_score: average score of this fingerprint for all OS
+        """
+        scores = self._entry_scores(self.encode([fp]))[0]
+        os_scores = np.bincount(self.entry_os, weights=scores,
+                                minlength=len(self.os_classes))
+        return self._avg_os_scores(os_scores)
+
+    def score_matrix(self, matrix):
+        """Score an already encoded matrix of fingerprints.
+
+        Returns:
+            A (fingerprints, os_classes) matrix with the summed OS scores
+        """
+        n_os = len(self.os_classes)
+        cells = max(1, len(self.columns) * len(self.fields))
+        chunk = max(1, self.max_cells // cells)
+        result = np.empty((len(matrix), n_os), dtype=np.float64)
+        for start in range(0, len(matrix), chunk):
+            part = matrix[start:start + chunk]
+            scores = self._entry_scores(part)
+            # one bincount for the whole chunk: offset the OS index of each row
+            index = np.arange(len(part))[:, None] * n_os + self.entry_os[None, :]
+            result[start:start + len(part)] = np.bincount(
+                index.ravel(), weights=scores.ravel(),
+                minlength=len(part) * n_os).reshape(len(part), n_os)
+        return result
+
+    def score_many(self, fps):
+        """Score a list of (normalized) fingerprints.
+
+        Returns:
+            list: One avg_os_score dict per fingerprint
+        """
+        if not fps:
+            return []
+        os_scores = self.score_matrix(self.encode(fps))
+        return [self._avg_os_scores(row) for row in os_scores]
@@ -0,0 +1,359 @@
+import socket
+import struct
+import dpkt
+from zardaxt_tcp_options import decode_tcp_options_raw, decode_tcp_options_dpkt
+from zardaxt_utils import TH_SYN, TH_ACK
+
+"""
+Turning captured frames into fingerprint dicts.
+
+fingerprint_from_dpkt() works on dpkt objects and is the original code path,
+including the decoding of the TCP options with dpkt.
+
+parse_syn() works directly on the raw frame bytes. It locates the TCP header
+by offset and checks the SYN/ACK flags before anything else is decoded, so
+that packets other than client SYNs are discarded without allocating any
+objects. Only for client SYNs the header fields are unpacked and the
+IP addresses converted to strings. It also walks 802.1Q/QinQ VLAN tags and
+IPv6 extension headers and never raises on truncated or malformed packets.
+"""
+
+ETH_HDR_LEN = 14
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_IP6 = 0x86DD
+ETH_TYPE_8021Q = 0x8100
+# 802.1Q, 802.1ad and the two pre-standard QinQ ethertypes
+ETH_TYPES_VLAN = (0x8100, 0x88A8, 0x9100, 0x9200)
+VLAN_TAG_LEN = 4
+
+IP_PROTO_TCP = 6
+IP_OFFMASK = 0x1FFF
+IP6_HDR_LEN = 40
+IP6_PROTO_HOPOPTS = 0
+IP6_PROTO_ROUTING = 43
+IP6_PROTO_FRAGMENT = 44
+IP6_PROTO_AH = 51
+IP6_PROTO_DSTOPTS = 60
+# The payload of ESP (50) is encrypted, so parsing ends there
+IP6_EXT_HEADERS = (IP6_PROTO_HOPOPTS, IP6_PROTO_ROUTING, IP6_PROTO_FRAGMENT,
+                   IP6_PROTO_AH, IP6_PROTO_DSTOPTS)
+
+TCP_HDR_LEN = 20
+TCP_FLAGS_MASK = 0x1FF
+
+IPV4_HDR = struct.Struct('!BBHHHBBH4s4s')
+IPV6_HDR = struct.Struct('!IHBB16s16s')
+TCP_HDR = struct.Struct('!HHIIHHHH')
+
+
+def make_fingerprint(ts, header_len, cap_len, src_ip, dst_ip, ip, tcp, tcp_options,
+                     decode_options=decode_tcp_options_raw):
+    """Build the fingerprint dict.
+
+    Args:
+        ip (dict): The IP header fields that differ between IPv4 and IPv6
+        tcp (tuple): sport, dport, seq, ack, off, flags, win, sum, urp
+        tcp_options (bytes): The raw TCP options
+        decode_options: Decodes the raw TCP options
+    """
+    sport, dport, seq, ack, off, flags, win, tcp_sum, urp = tcp
+    [str_opts, timestamp, timestamp_echo_reply, mss,
+        window_scaling, tcp_options_ordered] = decode_options(tcp_options)
+    return {
+        'ts': ts,
+        'header_len': header_len,
+        'cap_len': cap_len,
+        'src_ip': src_ip,
+        'dst_ip': dst_ip,
+        'src_port': sport,
+        'dst_port': dport,
+        'ip_hdr_length': ip['hl'],
+        'ip_version': ip['v'],
+        'ip_total_length': ip['len'],
+        'ip_tos': ip['tos'],
+        'ip_id': ip['id'],
+        'ip_ttl': ip['ttl'],
+        'ip_rf': ip['rf'],
+        'ip_df': ip['df'],
+        'ip_mf': ip['mf'],
+        'ip_off': ip['off'],
+        'ip_protocol': ip['p'],
+        'ip_checksum': ip['sum'],
+        'ip_plen': ip['plen'],
+        'ip_nxt': ip['nxt'],
+        # @TODO: this is likely not what we want (Probably just take tcp_off instead)
+        'tcp_header_length': TCP_HDR_LEN,
+        'tcp_off': off,
+        'tcp_window_size': win,
+        'tcp_checksum': tcp_sum,
+        'tcp_flags': flags,
+        'tcp_ack': ack,
+        'tcp_seq': seq,
+        'tcp_urp': urp,
+        'tcp_options': str_opts,
+        'tcp_options_ordered': tcp_options_ordered,
+        'tcp_window_scaling': window_scaling,
+        'tcp_timestamp': timestamp,
+        'tcp_timestamp_echo_reply': timestamp_echo_reply,
+        'tcp_mss': mss
+    }
+
+
+def fingerprint_from_dpkt(ts, header_len, cap_len, ip_pkt, ip_version):
+    """
+    Returns:
+        dict: The fingerprint of a client SYN, None for any other packet
+    """
+    tcp_pkt = None
+
+    if ip_pkt.p == dpkt.ip.IP_PROTO_TCP:
+        tcp_pkt = ip_pkt.data
+
+    # Sometimes I get the following error in production:
+    # File "/root/zardaxt/zardaxt.py", line 74, in process_packet
+    # is_syn = tcp_pkt.flags & TH_SYN
+    # AttributeError: 'bytes' object has no attribute 'flags'
+
+    # dpkt leaves the payload as bytes when the TCP header cannot be unpacked,
+    # e.g. because it was truncated by the snaplen, let's use hasattr() to check
+    # that tcp_pkt has the flags attribute
+    if not tcp_pkt or not hasattr(tcp_pkt, 'flags'):
+        return None
+
+    is_syn = tcp_pkt.flags & TH_SYN
+    is_ack = tcp_pkt.flags & TH_ACK
+
+    # The reason we are looking for a TCP segment that has the SYN flag
+    # but not the ACK flag is that we are only interested in packets
+    # coming from client to server and not the SYN+ACK from server to client.
+    if not is_syn or is_ack:
+        return None
+
+    addr_fam = socket.AF_INET
+    if ip_version == 6:
+        addr_fam = socket.AF_INET6
+
+    src_ip = socket.inet_ntop(addr_fam, ip_pkt.src)
+    dst_ip = socket.inet_ntop(addr_fam, ip_pkt.dst)
+
+    if ip_version == 4:
+        ip = {
+            'hl': ip_pkt.hl,
+            'v': ip_pkt.v,
+            'len': ip_pkt.len,
+            'tos': ip_pkt.tos,
+            'id': ip_pkt.id,
+            'ttl': ip_pkt.ttl,
+            'rf': ip_pkt.rf,
+            'df': ip_pkt.df,
+            'mf': ip_pkt.mf,
+            'off': ip_pkt.off,
+            'p': ip_pkt.p,
+            'sum': ip_pkt.sum,
+            'plen': None,
+            'nxt': None,
+        }
+    else:
+        ip = {
+            'hl': None,
+            'v': ip_pkt.v,
+            'len': len(ip_pkt),
+            'tos': None,
+            'id': None,
+            # Hop Limit (8 bits)
+            # Replaces the time to live field in IPv4.
+            # This value is decremented by one at each forwarding node and the packet is discarded
+            # if it becomes 0. However, the destination node should process the packet normally
+            # even if received with a hop limit of 0.
+            'ttl': ip_pkt.hlim,
+            'rf': None,
+            'df': None,
+            'mf': None,
+            'off': None,
+            'p': ip_pkt.p,
+            'sum': None,
+            'plen': ip_pkt.plen,
+            'nxt': ip_pkt.nxt,
+        }
+
+    tcp = (tcp_pkt.sport, tcp_pkt.dport, tcp_pkt.seq, tcp_pkt.ack, tcp_pkt.off,
+           tcp_pkt.flags, tcp_pkt.win, tcp_pkt.sum, tcp_pkt.urp)
+    return make_fingerprint(ts, header_len, cap_len, src_ip, dst_ip, ip, tcp, tcp_pkt.opts,
+                            decode_tcp_options_dpkt)
+
+
+def is_client_syn(buf, tcp_start):
+    # the TCP flags are the low 9 bits of the 2 bytes at offset 12
+    return buf[tcp_start + 13] & (TH_SYN | TH_ACK) == TH_SYN
+
+
+def maybe_client_syn(buf):
+    """A cheap check for the capture loop, before the frame is queued for parse_syn().
+
+    Returns:
+        bool: False if buf is certainly not a client SYN. Frames with VLAN tags
+            or IPv6 extension headers are left to parse_syn().
+    """
+    if len(buf) < ETH_HDR_LEN + 1:
+        return False
+    eth_type = (buf[12] << 8) | buf[13]
+    if eth_type == ETH_TYPE_IP:
+        tcp_start = ETH_HDR_LEN + (buf[ETH_HDR_LEN] & 0x0F) * 4
+        return len(buf) >= tcp_start + TCP_HDR_LEN and buf[ETH_HDR_LEN + 9] == IP_PROTO_TCP \
+            and is_client_syn(buf, tcp_start)
+    if eth_type == ETH_TYPE_IP6:
+        if len(buf) < ETH_HDR_LEN + IP6_HDR_LEN:
+            return False
+        if buf[ETH_HDR_LEN + 6] != IP_PROTO_TCP:
+            return buf[ETH_HDR_LEN + 6] in IP6_EXT_HEADERS
+        tcp_start = ETH_HDR_LEN + IP6_HDR_LEN
+        return len(buf) >= tcp_start + TCP_HDR_LEN and is_client_syn(buf, tcp_start)
+    return eth_type in ETH_TYPES_VLAN
+
+
+def parse_tcp(buf, tcp_start, tcp_end):
+    """Unpack the TCP header and the raw options of a client SYN."""
+    sport, dport, seq, ack, off_flags, win, tcp_sum, urp = TCP_HDR.unpack_from(
+        buf, tcp_start)
+    off = off_flags >> 12
+    if off << 2 < TCP_HDR_LEN:
+        return None, None
+    opts = bytes(buf[tcp_start + TCP_HDR_LEN:min(tcp_start + (off << 2), tcp_end)])
+    tcp = (sport, dport, seq, ack, off, off_flags & TCP_FLAGS_MASK, win, tcp_sum, urp)
+    return tcp, opts
+
+
+def parse_ipv4_syn(buf, offset, ts, header_len, cap_len):
+    end = len(buf)
+    if end - offset < 20 or buf[offset + 9] != IP_PROTO_TCP:
+        return None
+    hdr_len = (buf[offset] & 0xF) << 2
+    if hdr_len < 20:
+        return None
+    # fragments other than the first one do not contain a TCP header
+    if ((buf[offset + 6] << 8) | buf[offset + 7]) & IP_OFFMASK:
+        return None
+    total_length = (buf[offset + 2] << 8) | buf[offset + 3]
+    tcp_start = offset + hdr_len
+    if total_length:
+        end = min(end, offset + total_length)
+    if end - tcp_start < TCP_HDR_LEN or not is_client_syn(buf, tcp_start):
+        return None
+
+    tcp, opts = parse_tcp(buf, tcp_start, end)
+    if tcp is None:
+        return None
+    v_hl, tos, length, ip_id, flags_offset, ttl, p, ip_sum, src, dst = \
+        IPV4_HDR.unpack_from(buf, offset)
+    ip = {
+        'hl': v_hl & 0xF,
+        'v': v_hl >> 4,
+        'len': length,
+        'tos': tos,
+        'id': ip_id,
+        'ttl': ttl,
+        'rf': (flags_offset >> 15) & 1,
+        'df': (flags_offset >> 14) & 1,
+        'mf': (flags_offset >> 13) & 1,
+        'off': flags_offset,
+        'p': p,
+        'sum': ip_sum,
+        'plen': None,
+        'nxt': None,
+    }
+    return make_fingerprint(ts, header_len, cap_len,
+                            socket.inet_ntop(socket.AF_INET, src),
+                            socket.inet_ntop(socket.AF_INET, dst),
+                            ip, tcp, opts)
+
+
+def parse_ipv6_syn(buf, offset, ts, header_len, cap_len):
+    end = len(buf)
+    if end - offset < IP6_HDR_LEN:
+        return None
+    plen = (buf[offset + 4] << 8) | buf[offset + 5]
+    nxt = buf[offset + 6]
+    payload_start = offset + IP6_HDR_LEN
+    if plen:
+        end = min(end, payload_start + plen)
+
+    # walk the extension headers
+    next_header = nxt
+    tcp_start = payload_start
+    while next_header in IP6_EXT_HEADERS:
+        if end - tcp_start < 8:
+            return None
+        if next_header == IP6_PROTO_FRAGMENT:
+            # fragments other than the first one do not contain a TCP header
+            if ((buf[tcp_start + 2] << 8) | buf[tcp_start + 3]) >> 3:
+                return None
+            ext_len = 8
+        elif next_header == IP6_PROTO_AH:
+            ext_len = (buf[tcp_start + 1] + 2) << 2
+        else:
+            ext_len = (buf[tcp_start + 1] + 1) << 3
+        next_header = buf[tcp_start]
+        tcp_start += ext_len
+
+    if next_header != IP_PROTO_TCP or end - tcp_start < TCP_HDR_LEN \
+            or not is_client_syn(buf, tcp_start):
+        return None
+
+    tcp, opts = parse_tcp(buf, tcp_start, end)
+    if tcp is None:
+        return None
+    v_fc_flow, plen, nxt, hlim, src, dst = IPV6_HDR.unpack_from(buf, offset)
+    ip = {
+        'hl': None,
+        'v': v_fc_flow >> 28,
+        # IPv6 header, extension headers and TCP segment
+        'len': IP6_HDR_LEN + end - payload_start,
+        'tos': None,
+        'id': None,
+        # Hop Limit, replaces the time to live field in IPv4.
+        'ttl': hlim,
+        'rf': None,
+        'df': None,
+        'mf': None,
+        'off': None,
+        'p': IP_PROTO_TCP,
+        'sum': None,
+        'plen': plen,
+        'nxt': nxt,
+    }
+    return make_fingerprint(ts, header_len, cap_len,
+                            socket.inet_ntop(socket.AF_INET6, src),
+                            socket.inet_ntop(socket.AF_INET6, dst),
+                            ip, tcp, opts)
+
+
+def parse_syn(buf, ts, header_len, cap_len):
+    """Parse an Ethernet frame.
+
+    Args:
+        buf (bytes): The captured frame (bytes or memoryview)
+        ts (tuple): The capture timestamp (seconds, microseconds)
+        header_len (int): The length of the frame on the wire
+        cap_len (int): The captured length of the frame
+
+    Returns:
+        dict: The fingerprint of a client SYN, None for any other packet
+    """
+    if len(buf) < ETH_HDR_LEN:
+        return None
+    eth_type = (buf[12] << 8) | buf[13]
+    offset = ETH_HDR_LEN
+    if eth_type in ETH_TYPES_VLAN:
+        # up to two tags (double tagging aka QinQ)
+        for _ in range(2):
+            if len(buf) < offset + VLAN_TAG_LEN:
+                return None
+            eth_type = (buf[offset + 2] << 8) | buf[offset + 3]
+            offset += VLAN_TAG_LEN
+            if eth_type != ETH_TYPE_8021Q:
+                break
+    if eth_type == ETH_TYPE_IP:
+        return parse_ipv4_syn(buf, offset, ts, header_len, cap_len)
+    if eth_type == ETH_TYPE_IP6:
+        return parse_ipv6_syn(buf, offset, ts, header_len, cap_len)
+    return None
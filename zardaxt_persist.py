@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import queue
+import threading
+import traceback
+from zardaxt_logging import log
+from zardaxt_metrics import set_metrics
+from zardaxt_queue import BoundedQueue
+
+"""
+Persistence of the fingerprint store, off the capture and fingerprinting threads.
+
+Every fingerprint added to the store is appended to a journal (one compact
+JSON line [seq, added, fp] per fingerprint) by a background writer thread.
+The writer writes in batches and calls fsync() at most every
+persist_fsync_interval seconds.
+
+Every persist_snapshot_interval seconds the whole store is written to a
+snapshot (to a temporary file that replaces the previous snapshot atomically)
+and the journal is started over. The snapshot records the store sequence
+number it contains, journal lines with a lower or equal sequence number are
+already part of it.
+
+Write errors (e.g. a full disk) are counted and logged, the fingerprints
+are then dropped from the journal until the writer can write again. A
+batch that was written partially is cut off before writing again.
+Persistence never stops the capture.
+
+On startup, load() restores the store from the snapshot and the journal
+lines after it, so a restart does not lose the fingerprints.
+"""
+
+JOURNAL_FILE = 'journal.jsonl'
+SNAPSHOT_FILE = 'snapshot.json'
+# how long the writer waits before it reopens the journal after a write error
+RETRY_INTERVAL = 10
+
+
+def dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+class Persistence(object):
+    def __init__(self, config, store):
+        self.store = store
+        self.directory = config.get('persist_dir', 'persist')
+        self.journal_path = os.path.join(self.directory, JOURNAL_FILE)
+        self.snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        self.fsync_interval = config.get('persist_fsync_interval', 1)
+        self.snapshot_interval = config.get('persist_snapshot_interval', 300)
+        self.stats_interval = config.get('stats_interval', 60)
+        self.pending = BoundedQueue(config.get('persist_queue_size', 100000), 'drop_newest')
+        self.journal = None
+        # the size of the complete lines in the journal, None until it is opened
+        self.journal_size = None
+        self.stopped = threading.Event()
+        self.thread = None
+        self.counters = {
+            'journaled': 0,
+            'fsyncs': 0,
+            'snapshots': 0,
+            'last_snapshot_seq': 0,
+            'last_snapshot_ms': None,
+            'write_errors': 0,
+            'dropped': 0,
+            'restored': 0,
+            'load_ms': None,
+        }
+        self.last_error = None
+
+    def load(self):
+        """Restore the store from the snapshot and the journal, before start() is called.
+
+        Journal lines already contained in the snapshot are skipped, as well
+        as fingerprints that expired while zardaxt was not running and lines
+        that cannot be parsed. A torn last journal line (e.g. from a crash)
+        is cut off.
+        """
+        t0 = time.time()
+        deadline = t0 - self.store.ttl if self.store.ttl else 0
+        snapshot_seq = 0
+        restored = expired = replayed = corrupt = 0
+        try:
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path) as f:
+                    snapshot = json.load(f)
+                snapshot_seq = snapshot['seq']
+                # even if all entries of the snapshot expired, new fingerprints
+                # must not reuse its sequence numbers
+                self.store.next_seq(snapshot_seq)
+                # in sequence order, snapshots of older versions are in shard order
+                for ip, added, seq, fp in sorted(snapshot['entries'], key=lambda entry: entry[2]):
+                    if added < deadline:
+                        expired += 1
+                        continue
+                    self.store.restore(ip, added, seq, fp)
+                    restored += 1
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'rb') as f:
+                    good_size = 0
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            break
+                        good_size += len(line)
+                        try:
+                            seq, added, fp = json.loads(line)
+                            fp['ts'] = tuple(fp['ts'])
+                        except (ValueError, TypeError, KeyError):
+                            corrupt += 1
+                            continue
+                        if seq <= snapshot_seq:
+                            continue
+                        if added < deadline:
+                            expired += 1
+                            continue
+                        self.store.add(fp, now=added, seq=seq)
+                        replayed += 1
+                if good_size < os.path.getsize(self.journal_path):
+                    log('Cutting off a torn journal line at byte {}'.format(good_size),
+                        'persist', level='ERROR')
+                    os.truncate(self.journal_path, good_size)
+        except (OSError, ValueError, KeyError) as err:
+            # start with what could be restored rather than not at all
+            log('Could not restore the fingerprints: {}'.format(err), 'persist', level='ERROR')
+        self.store.expire()
+        self.counters['restored'] = restored + replayed
+        self.counters['load_ms'] = round((time.time() - t0) * 1000, 1)
+        log('Restored {} fingerprints from the snapshot and {} from the journal '
+            '(skipped {} expired, {} corrupt) in {}ms'.format(
+                restored, replayed, expired, corrupt, self.counters['load_ms']), 'persist')
+        self.report()
+
+    def on_add(self, seq, added, fp):
+        """Store listener, called for every added fingerprint (under the store lock)."""
+        self.pending.put((seq, added, fp))
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.store.add_listener(self.on_add)
+        self.thread = threading.Thread(target=self.run, name='zardaxt-persist', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        next_fsync = time.time() + self.fsync_interval
+        next_snapshot = time.time() + self.snapshot_interval
+        next_report = time.time() + self.stats_interval
+        retry_after = 0
+        while not self.stopped.is_set():
+            batch = []
+            try:
+                batch = self.take_batch(timeout=min(1, self.fsync_interval))
+                now = time.time()
+                if now >= next_report:
+                    next_report = now + self.stats_interval
+                    self.report()
+                if now < retry_after:
+                    self.counters['dropped'] += len(batch)
+                    continue
+                if batch:
+                    if self.journal is None:
+                        self.open_journal('a')
+                    self.write_batch(batch)
+                    batch = []
+                if self.journal is not None and now >= next_fsync:
+                    next_fsync = now + self.fsync_interval
+                    self.sync()
+                if now >= next_snapshot:
+                    next_snapshot = now + self.snapshot_interval
+                    self.write_snapshot()
+            except OSError as err:
+                self.counters['dropped'] += len(batch)
+                self.on_error(err)
+                retry_after = time.time() + RETRY_INTERVAL
+            except Exception as err:
+                log('persistence failed with error: {} and stack: {}'.format(
+                    err, traceback.format_exc()), 'persist', level='ERROR')
+
+    def take_batch(self, timeout, max_items=1000):
+        try:
+            batch = [self.pending.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < max_items:
+            try:
+                batch.append(self.pending.get(timeout=0))
+            except queue.Empty:
+                break
+        return batch
+
+    def open_journal(self, mode):
+        if mode == 'a' and self.journal_size is not None and os.path.exists(self.journal_path):
+            # cut off what a failed write left of a batch
+            os.truncate(self.journal_path, self.journal_size)
+        self.journal = open(self.journal_path, mode)
+        if mode == 'w' or self.journal_size is None:
+            self.journal_size = self.journal.tell()
+
+    def write_batch(self, batch):
+        data = ''.join(dumps(item) + '\n' for item in batch)
+        self.journal.write(data)
+        # written through, so that journal_size only counts complete batches
+        self.journal.flush()
+        self.journal_size += len(data)
+        self.counters['journaled'] += len(batch)
+
+    def sync(self):
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.counters['fsyncs'] += 1
+
+    def write_snapshot(self):
+        """Write all fingerprints of the store to the snapshot and start a new journal."""
+        t0 = time.time()
+        seq, entries = self.store.export()
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('{{"seq":{},"created":{},"entries":['.format(seq, t0))
+            for i, entry in enumerate(entries):
+                if i:
+                    f.write(',\n')
+                f.write(dumps(entry))
+            f.write(']}\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # the rename must be on disk before the journal is truncated
+        self.sync_directory()
+        # Everything up to seq is in the snapshot now. Lines with a higher seq
+        # that are still pending go to the new journal.
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.open_journal('w')
+        self.counters['snapshots'] += 1
+        self.counters['last_snapshot_seq'] = seq
+        self.counters['last_snapshot_ms'] = round((time.time() - t0) * 1000, 1)
+        log('Wrote snapshot of {} fingerprints (seq {}) in {}ms'.format(
+            len(entries), seq, self.counters['last_snapshot_ms']), 'persist')
+
+    def sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def on_error(self, err):
+        self.counters['write_errors'] += 1
+        self.last_error = str(err)
+        if self.journal is not None:
+            try:
+                self.journal.close()
+            except OSError:
+                pass
+            self.journal = None
+        log('persistence write failed: {}, retrying in {}s'.format(
+            err, RETRY_INTERVAL), 'persist', level='ERROR')
+
+    def report(self):
+        values = dict(self.counters)
+        values['pending'] = len(self.pending)
+        values['dropped'] += self.pending.dropped
+        values['last_error'] = self.last_error
+        set_metrics('persistence', values)
+        return values
+
+    def close(self, timeout=10):
+        """Write the pending fingerprints and a final snapshot, used on shutdown."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        try:
+            if self.journal is not None:
+                self.write_batch(self.take_batch(timeout=0, max_items=len(self.pending) + 1))
+                self.sync()
+            self.write_snapshot()
+            self.journal.close()
+        except OSError as err:
+            self.on_error(err)
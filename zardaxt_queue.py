@@ -0,0 +1,86 @@
+import queue
+import threading
+from collections import deque
+
+"""
+A bounded queue between the capture loop and the fingerprinting.
+
+The capture loop must never wait for a slow consumer (logging, writing
+fingerprints.json), otherwise the kernel drops packets. When the queue is
+full, the overflow policy decides what happens:
+
+- drop_newest: the new item is dropped (default)
+- drop_oldest: the oldest queued item is dropped to make room
+- block: put() waits until the consumer made room
+"""
+
+OVERFLOW_POLICIES = ('drop_newest', 'drop_oldest', 'block')
+
+
+class BoundedQueue(object):
+    def __init__(self, max_size, overflow_policy='drop_newest'):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise Exception('Unknown overflow policy: {}'.format(overflow_policy))
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.enqueued = 0
+        self.dropped = 0
+        self.high_water_mark = 0
+
+    def put(self, item):
+        """Add item, applying the overflow policy if the queue is full.
+
+        Returns:
+            bool: False if item was dropped
+        """
+        with self.lock:
+            if len(self.items) >= self.max_size:
+                if self.overflow_policy == 'drop_newest':
+                    self.dropped += 1
+                    return False
+                elif self.overflow_policy == 'drop_oldest':
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self.items) >= self.max_size:
+                        self.not_full.wait()
+            self.items.append(item)
+            self.enqueued += 1
+            if len(self.items) > self.high_water_mark:
+                self.high_water_mark = len(self.items)
+            self.not_empty.notify()
+            return True
+
+    def get(self, timeout=None):
+        """Remove and return the oldest item.
+
+        Raises:
+            queue.Empty: If no item arrived within timeout seconds
+        """
+        with self.lock:
+            if not self.items:
+                self.not_empty.wait_for(lambda: self.items, timeout)
+                if not self.items:
+                    raise queue.Empty
+            item = self.items.popleft()
+            if self.overflow_policy == 'block':
+                self.not_full.notify()
+            return item
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.items),
+                'max_size': self.max_size,
+                'overflow_policy': self.overflow_policy,
+                'high_water_mark': self.high_water_mark,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+            }
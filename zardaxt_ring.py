@@ -0,0 +1,154 @@
+import mmap
+import select
+import socket
+import struct
+from zardaxt_logging import log
+from zardaxt_afpacket import open_socket, attach_filter, set_bpf_program, \
+    read_packet_statistics, SOL_PACKET, SO_ATTACH_FILTER, BPF_RET_K
+from zardaxt_capture import MAX_BYTES
+
+"""
+Capture from a memory mapped TPACKET_V3 ring of an AF_PACKET socket.
+
+The kernel writes the packets into blocks of a ring buffer shared with
+user space and hands over a whole block at once (when it is full or when
+read_timeout expired). The frames are read in place through memoryviews
+into the ring, there is no system call and no copy per packet.
+
+Does not need pcapy, except for compiling custom pcap_filter expressions.
+"""
+
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# struct tpacket_req3
+TPACKET_REQ3 = struct.Struct('IIIIIII')
+# struct tpacket_block_desc { version; offset_to_priv; struct tpacket_hdr_v1 { block_status;
+# num_pkts; offset_to_first_pkt; ... } }
+BLOCK_DESC = struct.Struct('IIIII')
+BLOCK_STATUS_OFFSET = 8
+BLOCK_STATUS = struct.Struct('I')
+# struct tpacket3_hdr { tp_next_offset; tp_sec; tp_nsec; tp_snaplen; tp_len; tp_status; tp_mac; tp_net; ... }
+TPACKET3_HDR = struct.Struct('IIIIIIHH')
+# the struct sockaddr_ll follows the (aligned) tpacket3_hdr, sll_pkttype is at offset 10
+SLL_PKTTYPE_OFFSET = 48 + 10
+PACKET_OUTGOING = 4
+
+
+class TPacketV3Ring(object):
+    """A TPACKET_V3 receive ring on interface.
+
+    Config:
+        ring_block_size (int): Bytes per block, a power of two multiple of the page size
+        ring_block_count (int): Number of blocks in the ring, defaults to
+            capture_buffer_size / ring_block_size when capture_buffer_size is set
+        read_timeout (int): Milliseconds after which the kernel hands over a block
+            that is not full yet, 1 with immediate_mode
+    """
+
+    def __init__(self, interface, pcap_filter, config):
+        self.interface = interface
+        self.block_size = config.get('ring_block_size', 1 << 18)
+        default_block_count = 64
+        if config.get('capture_buffer_size', 0):
+            default_block_count = max(1, config['capture_buffer_size'] // self.block_size)
+        self.block_count = config.get('ring_block_count', default_block_count)
+        self.buffer_size = self.block_size * self.block_count
+        block_timeout = 1 if config.get('immediate_mode', False) else config.get('read_timeout', 1)
+        frame_size = 2048
+        self.sock = open_socket(interface)
+        self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        # The return value of the socket filter is the number of bytes
+        # copied into the ring, so the filter also sets the snaplen
+        if not attach_filter(self.sock, pcap_filter, MAX_BYTES):
+            if pcap_filter:
+                log('Cannot compile the pcap filter without pcapy, capturing unfiltered',
+                    'ring', level='ERROR')
+            set_bpf_program(self.sock, socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                            [(BPF_RET_K, 0, 0, MAX_BYTES)])
+        self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, TPACKET_REQ3.pack(
+            self.block_size, self.block_count, frame_size,
+            self.block_size // frame_size * self.block_count,
+            block_timeout, 0, 0))
+        self.ring = mmap.mmap(self.sock.fileno(), self.buffer_size,
+                              mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.view = memoryview(self.ring)
+        self.poller = select.poll()
+        self.poller.register(self.sock.fileno(), select.POLLIN | select.POLLERR)
+        self.block = 0
+        # like libpcap, skip the outgoing copy of packets on the loopback
+        # interface, every packet would be seen twice otherwise
+        self.skip_outgoing = interface == 'lo'
+        self.received = 0
+        self.dropped = 0
+
+    def dispatch(self, on_frame, timeout=1000):
+        """Hand every frame of the blocks released by the kernel to on_frame.
+
+        Waits up to timeout milliseconds for the next block if none is ready.
+
+        Args:
+            on_frame (function): Called with (ts, header_len, cap_len, buf) for each
+                frame, buf is a memoryview into the ring that is only valid
+                during the call
+
+        Returns:
+            int: The number of frames read
+        """
+        ring = self.ring
+        view = self.view
+        skip_outgoing = self.skip_outgoing
+        num_frames = 0
+        released = False
+        polled = False
+        while True:
+            block_offset = self.block * self.block_size
+            _, _, status, num_pkts, offset = BLOCK_DESC.unpack_from(ring, block_offset)
+            if not status & TP_STATUS_USER:
+                if released or polled:
+                    break
+                self.poller.poll(timeout)
+                polled = True
+                continue
+            frame_offset = block_offset + offset
+            for _ in range(num_pkts):
+                next_offset, sec, nsec, cap_len, header_len, _, mac, _ = \
+                    TPACKET3_HDR.unpack_from(ring, frame_offset)
+                if not skip_outgoing or ring[frame_offset + SLL_PKTTYPE_OFFSET] != PACKET_OUTGOING:
+                    start = frame_offset + mac
+                    on_frame((sec, nsec // 1000), header_len, cap_len, view[start:start + cap_len])
+                    num_frames += 1
+                frame_offset += next_offset
+            # return the block to the kernel
+            BLOCK_STATUS.pack_into(ring, block_offset + BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+            self.block = (self.block + 1) % self.block_count
+            released = True
+        return num_frames
+
+    def stats(self):
+        """The counters since the ring was created, like pcapy's stats().
+
+        Returns:
+            (int, int, int): received, dropped (because the ring was full), 0
+        """
+        packets, drops = read_packet_statistics(self.sock)
+        self.received += packets
+        self.dropped += drops
+        return self.received, self.dropped, 0
+
+    def run(self, on_frame, periodic=None):
+        log('Capturing from a TPACKET_V3 ring of {} x {} bytes'.format(
+            self.block_count, self.block_size), 'ring')
+        while True:
+            self.dispatch(on_frame)
+            if periodic is not None:
+                periodic()
+
+    def close(self):
+        self.view.release()
+        self.ring.close()
+        self.sock.close()
@@ -0,0 +1,177 @@
+import time
+import signal
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+import zardaxt_utils
+from zardaxt_logging import log
+from zardaxt_metrics import set_metrics
+
+"""
+Scoring of API lookups in worker processes.
+
+The API and the capture loop share one GIL, so a burst of lookups that
+need scoring takes time from reading packets. With scoring_workers > 0,
+the API sends the normalized fingerprints it has to score to a pool of
+worker processes instead (score cache hits are still answered in the API
+thread). The distinct fingerprints of a batch lookup are sent to a worker
+together.
+
+The workers are forked when the pool is started, before the API and the
+capture threads run. They share the score tables of the loaded database
+copy-on-write. Forking later, from a process with running threads, could
+copy a lock some thread holds. So scoring_spare_pools replacement pools are
+forked at startup as well. When a worker fails, the pool is replaced by a
+spare. Without spares left, the API scores inline from then on.
+
+A lookup waits at most scoring_timeout seconds for a worker. On a timeout
+or a failed worker, the fingerprint is scored in the API thread instead,
+so a lookup is always answered.
+"""
+
+
+def init_worker():
+    # the signal handlers of the main process write fingerprints.json
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTSTP, signal.SIG_IGN)
+
+
+def score_in_worker(normalized_fp):
+    return zardaxt_utils.score_normalized_fp(normalized_fp)
+
+
+def score_many_in_worker(normalized_fps):
+    return zardaxt_utils.score_normalized_fps(normalized_fps)
+
+
+class ScoringPool(object):
+    def __init__(self, config):
+        self.num_workers = config.get('scoring_workers', 0)
+        self.timeout = config.get('scoring_timeout', 0.5)
+        self.stats_interval = config.get('stats_interval', 60)
+        self.num_spares = config.get('scoring_spare_pools', 1)
+        # None once the last pool failed
+        self.executor = None
+        # pools forked at startup to replace a failed one
+        self.spares = []
+        self.lock = threading.Lock()
+        # scoring latencies in ms of the recent lookups
+        self.latencies = deque(maxlen=1000)
+        self.in_flight = 0
+        self.next_report = time.time() + self.stats_interval
+        self.counters = {
+            'scored': 0,
+            'timeouts': 0,
+            'errors': 0,
+            'fallbacks': 0,
+            'restarts': 0,
+        }
+
+    def start(self):
+        """Fork the workers and the spare pools, call before other threads are started."""
+        self.executor = self.fork_pool()
+        self.spares = [self.fork_pool() for _ in range(self.num_spares)]
+        log('Started {} scoring workers and {} spare pools'.format(
+            self.num_workers, self.num_spares), 'scoring_pool')
+
+    def fork_pool(self):
+        executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=init_worker)
+        # with fork, all workers are started by the first submit()
+        executor.submit(int).result()
+        return executor
+
+    def restart(self, failed):
+        """Replace the failed executor by a spare, unless another lookup did so already."""
+        with self.lock:
+            if self.executor is not failed:
+                return
+            self.counters['restarts'] += 1
+            self.executor = self.spares.pop() if self.spares else None
+        if self.executor is None:
+            log('No spare scoring pool left, scoring in the API threads from now on',
+                'scoring_pool', level='ERROR')
+        failed.shutdown(wait=False, cancel_futures=True)
+
+    def score(self, normalized_fp):
+        """Score the normalized fingerprint in a worker, used as scorer of guess_os_scores().
+
+        Returns:
+            avg_os_score: average score of the fingerprint for all OS
+        """
+        return self.run(score_in_worker, normalized_fp, zardaxt_utils.score_normalized_fp)
+
+    def score_many(self, normalized_fps):
+        """Score the normalized fingerprints in one worker, see batch_os_scores().
+
+        Returns:
+            list: avg_os_score of every fingerprint
+        """
+        return self.run(score_many_in_worker, normalized_fps, zardaxt_utils.score_normalized_fps)
+
+    def run(self, worker_fn, arg, inline_fn):
+        t0 = time.time()
+        with self.lock:
+            self.in_flight += 1
+        try:
+            result = self.score_remote(worker_fn, arg)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        # the counters are updated by all API threads
+        with self.lock:
+            self.counters['scored' if result is not None else 'fallbacks'] += 1
+        if result is None:
+            result = inline_fn(arg)
+        self.latencies.append((time.time() - t0) * 1000)
+        if time.time() >= self.next_report:
+            self.next_report = time.time() + self.stats_interval
+            self.report()
+        return result
+
+    def score_remote(self, worker_fn, arg):
+        """The result of worker_fn(arg) in a worker, None if it has to be computed inline."""
+        executor = self.executor
+        if executor is None:
+            return None
+        try:
+            future = executor.submit(worker_fn, arg)
+            result = future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            with self.lock:
+                self.counters['timeouts'] += 1
+            return None
+        except Exception as err:
+            # e.g. BrokenProcessPool when a worker was killed
+            with self.lock:
+                self.counters['errors'] += 1
+            log('scoring worker failed: {}, replacing the pool'.format(err),
+                'scoring_pool', level='ERROR')
+            self.restart(executor)
+            return None
+        return result
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        with self.lock:
+            values = dict(self.counters)
+        values['workers'] = self.num_workers if self.executor is not None else 0
+        values['spare_pools'] = len(self.spares)
+        values['queue_depth'] = self.in_flight
+        if latencies:
+            values['latency_ms'] = {
+                'avg': round(sum(latencies) / len(latencies), 3),
+                'p50': round(latencies[len(latencies) // 2], 3),
+                'p99': round(latencies[int(len(latencies) * 0.99)], 3),
+                'max': round(latencies[-1], 3),
+            }
+        return values
+
+    def report(self):
+        values = self.stats()
+        set_metrics('scoring_pool', values)
+        return values
@@ -0,0 +1,517 @@
+import sys
+import time
+import threading
+from collections import OrderedDict, deque
+from zardaxt_record import FingerprintRecord
+from zardaxt_utils import fp_signature
+
+"""
+In memory store of the fingerprints per source IP.
+
+Replaces clearing all fingerprints whenever clear_dict_after IPs are stored.
+Instead, the store is bounded by:
+
+- store_max_ips: IPs not updated for the longest time are evicted first (LRU)
+- store_max_fingerprints_per_ip: only the newest fingerprints of an IP are kept
+- store_max_fingerprints: total number of fingerprints
+- store_max_memory: estimated size of the fingerprints in bytes (0 = no limit)
+- store_ttl: fingerprints older than this many seconds expire (0 = never)
+
+The IPs are kept in least recently updated order, so expiry and eviction
+only ever remove from the front and are amortized O(1) per added fingerprint.
+
+With store_aggregate, the fingerprints of an IP that have the same signature
+(they only differ in ports, sequence numbers, timestamps and the like) are
+collapsed into one Aggregate with a count, the first and last time it was
+seen and the most recent source ports. store_max_fingerprints_per_ip then
+limits the number of distinct signatures per IP.
+
+The fingerprints are stored as compact FingerprintRecords, get() returns
+the stored entries and snapshot() the fingerprint dicts. export() and
+restore() are used to persist the store across restarts (zardaxt_persist.py).
+
+The IPs are spread over store_shards shards by hash, every shard has its
+own lock, LRU order and an equal share of the limits. Adding a fingerprint
+and reading an IP only lock the shard of the IP, so API lookups and the
+capture path rarely wait for each other. lookup() returns the newest entry
+of an IP without copying its history. snapshot() copies one shard at a
+time, export() locks all shards for a consistent view with a sequence number.
+"""
+
+
+class StoredFingerprint(object):
+    __slots__ = ('added', 'seq', 'size', 'record', 'scores')
+    # the number of SYNs the entry stands for
+    count = 1
+
+    def __init__(self, added, seq, record):
+        self.added = added
+        self.seq = seq
+        self.record = record
+        # set by the classifier, see set_scores()
+        self.scores = None
+        self.size = record.size() + sys.getsizeof(self)
+
+    def to_dict(self):
+        return self.record.to_dict()
+
+
+class Aggregate(StoredFingerprint):
+    """All SYNs of an IP with the same signature, record is the newest one."""
+    __slots__ = ('count', 'first_seen', 'ports')
+
+    def __init__(self, added, seq, record, port):
+        self.count = 1
+        self.first_seen = added
+        self.ports = [port]
+        super().__init__(added, seq, record)
+
+    def to_dict(self):
+        fp = self.record.to_dict()
+        fp['count'] = self.count
+        fp['first_seen'] = self.first_seen
+        fp['last_seen'] = self.added
+        fp['recent_ports'] = list(self.ports)
+        return fp
+
+
+class AggregatedHistory(object):
+    """The Aggregates of an IP by signature, least recently seen first.
+
+    Offers the part of the deque interface used by FingerprintStore.
+    """
+
+    def __init__(self):
+        self.aggregates = OrderedDict()
+        # the number of SYNs of all aggregates
+        self.syns = 0
+
+    def __len__(self):
+        return len(self.aggregates)
+
+    def __iter__(self):
+        return iter(self.aggregates.values())
+
+    def __getitem__(self, index):
+        if index == 0:
+            return next(iter(self.aggregates.values()))
+        if index == -1:
+            return next(reversed(self.aggregates.values()))
+        raise IndexError(index)
+
+    def popleft(self):
+        aggregate = self.aggregates.popitem(last=False)[1]
+        self.syns -= aggregate.count
+        return aggregate
+
+
+def share(limit, num_shards, i):
+    """The part of limit for shard i, the parts add up to limit (unless it is below num_shards)."""
+    if not limit:
+        return limit
+    return max(1, limit // num_shards + (i < limit % num_shards))
+
+
+class StoreShard(object):
+    """The IPs of one shard of the store, only used with lock held."""
+
+    def __init__(self, max_ips, max_fingerprints, max_memory):
+        self.max_ips = max_ips
+        self.max_fingerprints = max_fingerprints
+        self.max_memory = max_memory
+        # ip -> StoredFingerprints (deque) or Aggregates (AggregatedHistory),
+        # oldest first. The least recently updated IP is the first key.
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.num_fingerprints = 0
+        self.memory = 0
+        self.counters = {
+            'added': 0,
+            'aggregated': 0,
+            'expired': 0,
+            'evicted_lru': 0,
+            'evicted_history': 0,
+            'lookups': 0,
+            'hits': 0,
+            # lookups that waited for a fingerprint, see FingerprintStore.lookup()
+            'waits': 0,
+            'wait_timeouts': 0,
+        }
+        # ip -> [Event, number of waiting lookups], the event is set when
+        # a fingerprint of ip is added
+        self.waiters = {}
+
+    def history(self, ip, aggregate):
+        """The history of ip, created if there is none, as most recently updated IP."""
+        history = self.entries.get(ip)
+        if history is None:
+            history = AggregatedHistory() if aggregate else deque()
+            self.entries[ip] = history
+        else:
+            self.entries.move_to_end(ip)
+        return history
+
+    def append(self, history, entry):
+        history.append(entry)
+        self.num_fingerprints += 1
+        self.memory += entry.size
+
+    def add_aggregated(self, history, signature, now, seq, record, port, max_recent_ports):
+        history.syns += 1
+        aggregate = history.aggregates.get(signature)
+        if aggregate is None:
+            aggregate = Aggregate(now, seq, record, port)
+            history.aggregates[signature] = aggregate
+            self.num_fingerprints += 1
+            self.memory += aggregate.size
+            return
+        history.aggregates.move_to_end(signature)
+        self.counters['aggregated'] += 1
+        aggregate.count += 1
+        aggregate.added = now
+        aggregate.seq = seq
+        aggregate.record = record
+        aggregate.ports.append(port)
+        if len(aggregate.ports) > max_recent_ports:
+            del aggregate.ports[0]
+
+    def remove_oldest(self, history, reason):
+        entry = history.popleft()
+        self.num_fingerprints -= 1
+        self.memory -= entry.size
+        self.counters[reason] += 1
+
+    def remove_ip(self, ip, reason):
+        history = self.entries.pop(ip)
+        self.num_fingerprints -= len(history)
+        self.memory -= sum(entry.size for entry in history)
+        self.counters[reason] += len(history)
+
+    def expire(self, now, ttl):
+        if not ttl:
+            return
+        deadline = now - ttl
+        while self.entries:
+            ip, history = next(iter(self.entries.items()))
+            # the newest fingerprint of the least recently updated IP
+            if history[-1].added >= deadline:
+                break
+            self.remove_ip(ip, 'expired')
+
+    def evict(self):
+        while self.entries and (
+                len(self.entries) > self.max_ips or
+                self.num_fingerprints > self.max_fingerprints or
+                (self.max_memory and self.memory > self.max_memory)):
+            ip = next(iter(self.entries))
+            self.remove_ip(ip, 'evicted_lru')
+
+    def fresh_history(self, ip, now, ttl):
+        """The history of ip without expired fingerprints, None if there is none."""
+        history = self.entries.get(ip)
+        if history is None:
+            return None
+        if ttl:
+            deadline = now - ttl
+            while history and history[0].added < deadline:
+                self.remove_oldest(history, 'expired')
+            if not history:
+                del self.entries[ip]
+                return None
+        return history
+
+
+class FingerprintStore(object):
+    def __init__(self, config):
+        max_ips = config.get('store_max_ips', config.get('clear_dict_after', 5000))
+        max_fingerprints = config.get('store_max_fingerprints', 100000)
+        max_memory = config.get('store_max_memory', 0)
+        self.max_per_ip = config.get('store_max_fingerprints_per_ip', 20)
+        self.ttl = config.get('store_ttl', 3600)
+        self.aggregate = config.get('store_aggregate', False)
+        self.max_recent_ports = config.get('store_recent_ports', 8)
+        num_shards = config.get('store_shards', 16)
+        self.shards = [StoreShard(share(max_ips, num_shards, i),
+                                  share(max_fingerprints, num_shards, i),
+                                  share(max_memory, num_shards, i))
+                       for i in range(num_shards)]
+        # called with (seq, added, fp) for every added fingerprint, see add_listener()
+        self.listeners = []
+        # the sequence number is assigned with the lock of the shard held, see export()
+        self.seq = 0
+        self.seq_lock = threading.Lock()
+
+    def shard(self, ip):
+        return self.shards[hash(ip) % len(self.shards)]
+
+    def next_seq(self, seq=None):
+        with self.seq_lock:
+            self.seq = self.seq + 1 if seq is None else max(self.seq, seq)
+            return self.seq if seq is None else seq
+
+    def add(self, fp, now=None, seq=None):
+        """Store the fingerprint of fp['src_ip'].
+
+        seq is only passed when replaying a journal.
+
+        Returns:
+            int: The sequence number assigned to the fingerprint
+        """
+        if now is None:
+            now = time.time()
+        ip = fp['src_ip']
+        record = FingerprintRecord(fp)
+        signature = fp_signature(fp) if self.aggregate else None
+        shard = self.shard(ip)
+        with shard.lock:
+            seq = self.next_seq(seq)
+            shard.counters['added'] += 1
+            history = shard.history(ip, self.aggregate)
+            if self.aggregate:
+                shard.add_aggregated(history, signature, now, seq, record, fp['src_port'],
+                                     self.max_recent_ports)
+            else:
+                shard.append(history, StoredFingerprint(now, seq, record))
+            if len(history) > self.max_per_ip:
+                shard.remove_oldest(history, 'evicted_history')
+            shard.expire(now, self.ttl)
+            shard.evict()
+            waiter = shard.waiters.pop(ip, None)
+            if waiter is not None:
+                waiter[0].set()
+            for listener in self.listeners:
+                listener(seq, now, fp)
+            return seq
+
+    def add_listener(self, listener):
+        """Call listener(seq, added, fp) for every added fingerprint.
+
+        The listener is called while the shard of the IP is locked, so it sees
+        the fingerprints of an IP in sequence order. It must be cheap and must
+        not use the store. Call before fingerprints are added.
+        """
+        self.listeners.append(listener)
+
+    def restore(self, ip, added, seq, fp):
+        """Add an entry returned by export(), keeping its time and sequence number.
+
+        The entries must be restored in sequence order, as export() returns
+        them, so that the IPs of every shard are in update order again (the
+        shard of an IP depends on the hash seed of the process).
+        Aggregates are split into their fields again. Without store_aggregate
+        only their newest fingerprint is restored.
+        """
+        count = fp.pop('count', 1)
+        first_seen = fp.pop('first_seen', added)
+        fp.pop('last_seen', None)
+        ports = fp.pop('recent_ports', None) or [fp['src_port']]
+        fp['ts'] = tuple(fp['ts'])
+        record = FingerprintRecord(fp)
+        signature = fp_signature(fp) if self.aggregate else None
+        shard = self.shard(ip)
+        with shard.lock:
+            self.next_seq(seq)
+            history = shard.history(ip, self.aggregate)
+            if self.aggregate:
+                aggregate = history.aggregates.pop(signature, None)
+                if aggregate is None:
+                    aggregate = Aggregate(first_seen, seq, record, ports[0])
+                    aggregate.count = 0
+                    aggregate.ports = []
+                    shard.num_fingerprints += 1
+                    shard.memory += aggregate.size
+                history.aggregates[signature] = aggregate
+                history.syns += count
+                aggregate.count += count
+                aggregate.added = added
+                aggregate.seq = seq
+                aggregate.record = record
+                aggregate.ports = (aggregate.ports + ports)[-self.max_recent_ports:]
+            else:
+                shard.append(history, StoredFingerprint(added, seq, record))
+            if len(history) > self.max_per_ip:
+                shard.remove_oldest(history, 'evicted_history')
+            shard.evict()
+
+    def expire(self, now=None):
+        """Remove all expired fingerprints, e.g. after restoring the store."""
+        if now is None:
+            now = time.time()
+        for shard in self.shards:
+            with shard.lock:
+                shard.expire(now, self.ttl)
+                for ip in list(shard.entries):
+                    shard.fresh_history(ip, now, self.ttl)
+
+    def get(self, ip, now=None):
+        """
+        Returns:
+            list: The StoredFingerprints of ip, oldest first (empty if there are none).
+                The newest one is the last.
+        """
+        if now is None:
+            now = time.time()
+        shard = self.shard(ip)
+        with shard.lock:
+            shard.counters['lookups'] += 1
+            history = shard.fresh_history(ip, now, self.ttl)
+            if history is None:
+                return []
+            shard.counters['hits'] += 1
+            return list(history)
+
+    def lookup(self, ip, now=None, timeout=0):
+        """The newest fingerprint of ip, without copying its history.
+
+        If there is none and timeout is given, waits up to timeout seconds
+        until a fingerprint of ip is added, e.g. when the HTTP request of a
+        new connection is faster than the capture of its SYN.
+
+        Returns:
+            (StoredFingerprint, int): The newest entry and the number of SYNs
+                of ip, (None, 0) if there is none
+        """
+        if now is None:
+            now = time.time()
+        shard = self.shard(ip)
+        with shard.lock:
+            shard.counters['lookups'] += 1
+            history = shard.fresh_history(ip, now, self.ttl)
+            if history is not None or not timeout:
+                return self.newest(shard, history)
+            waiter = shard.waiters.get(ip)
+            if waiter is None:
+                waiter = shard.waiters[ip] = [threading.Event(), 0]
+            waiter[1] += 1
+        added = waiter[0].wait(timeout)
+        with shard.lock:
+            waiter[1] -= 1
+            if not waiter[1] and shard.waiters.get(ip) is waiter:
+                del shard.waiters[ip]
+            shard.counters['waits' if added else 'wait_timeouts'] += 1
+            return self.newest(shard, shard.fresh_history(ip, time.time(), self.ttl))
+
+    def newest(self, shard, history):
+        if history is None:
+            return None, 0
+        shard.counters['hits'] += 1
+        return history[-1], history.syns if self.aggregate else len(history)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: A copy of all fingerprints as {ip: [fp, ...]}, each shard
+                is copied in one go
+        """
+        fingerprints = {}
+        for shard in self.shards:
+            with shard.lock:
+                entries = [(ip, list(history)) for ip, history in shard.entries.items()]
+            # convert outside of the lock
+            for ip, history in entries:
+                fingerprints[ip] = [entry.to_dict() for entry in history]
+        return fingerprints
+
+    def set_scores(self, ip, seq, scores):
+        """Attach the classification of fingerprint seq to the newest entry of ip.
+
+        An Aggregate keeps its scores when more SYNs are added to it, they
+        have the same signature and therefore the same scores.
+
+        Returns:
+            bool: False if the entry was removed or a newer fingerprint of ip was added meanwhile
+        """
+        shard = self.shard(ip)
+        with shard.lock:
+            history = shard.entries.get(ip)
+            if not history or history[-1].seq != seq:
+                return False
+            history[-1].scores = scores
+            return True
+
+    def changes(self, cursor=0, since=0, limit=None):
+        """The IPs updated after sequence number cursor, in update order.
+
+        Used to page through or tail the store. Every shard is walked from
+        its most recently updated IP until cursor, so tailing only costs as
+        much as was added. An IP updated again later is returned again with
+        all its fingerprints.
+
+        Args:
+            cursor: the next cursor of the previous call, 0 for all IPs
+            since: only IPs updated at or after this unix time
+            limit: at most this many IPs
+
+        Returns:
+            (int, list): The next cursor and the IPs as [(ip, seq, [StoredFingerprint, ...])],
+                seq is the sequence number of the newest fingerprint of ip
+        """
+        # IPs updated while walking the shards are left for the next call
+        end = self.seq
+        changed = []
+        for shard in self.shards:
+            with shard.lock:
+                found = []
+                # the IPs of a shard are in update order, thus sorted by their newest seq
+                for ip, history in reversed(shard.entries.items()):
+                    seq = history[-1].seq
+                    if seq <= cursor:
+                        break
+                    if seq <= end and history[-1].added >= since:
+                        found.append((seq, ip, history))
+                if limit is not None:
+                    # only the oldest limit IPs of the shard can be returned
+                    found = found[-limit:]
+                changed.extend((seq, ip, list(history)) for seq, ip, history in found)
+        changed.sort()
+        if limit is not None and len(changed) > limit:
+            del changed[limit:]
+            end = changed[-1][0]
+        return end, [(ip, seq, history) for seq, ip, history in changed]
+
+    def export(self):
+        """All entries, for persisting the store.
+
+        All shards are locked while the entries are collected, so the entries
+        are exactly the fingerprints up to the returned sequence number.
+
+        Returns:
+            (int, list): The sequence number of the newest fingerprint and
+                the entries as [ip, added, seq, fp] lists, sorted by seq
+        """
+        for shard in self.shards:
+            shard.lock.acquire()
+        try:
+            seq = self.seq
+            entries = [(ip, list(history)) for shard in self.shards
+                       for ip, history in shard.entries.items()]
+        finally:
+            for shard in self.shards:
+                shard.lock.release()
+        # the shards are interleaved, restore() needs the entries in sequence order
+        entries = sorted(((ip, entry) for ip, history in entries for entry in history),
+                         key=lambda item: item[1].seq)
+        return seq, [[ip, entry.added, entry.seq, entry.to_dict()] for ip, entry in entries]
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self.shards)
+
+    def stats(self):
+        values = None
+        for shard in self.shards:
+            with shard.lock:
+                if values is None:
+                    values = dict(shard.counters)
+                    values['ips'] = 0
+                    values['fingerprints'] = 0
+                    values['memory'] = 0
+                else:
+                    for name, value in shard.counters.items():
+                        values[name] += value
+                values['ips'] += len(shard.entries)
+                values['fingerprints'] += shard.num_fingerprints
+                values['memory'] += shard.memory
+        values['shards'] = len(self.shards)
+        values['hit_rate'] = round(values['hits'] / values['lookups'], 4) \
+            if values['lookups'] else None
+        return values
@@ -1,5 +1,7 @@
 import struct
+from dpkt.tcp import parse_opts
 from zardaxt_logging import log
+from zardaxt_cache import LRUCache
 
 """
 Parse TCP options.
@@ -8,6 +10,13 @@ TCP options is probably the most valuable source of entropy in
 TCP SYN packets.
 
 https://www.iana.org/assignments/tcp-parameters/tcp-parameters.xhtml
+
+decode_tcp_options_raw() decodes the raw option bytes. Apart from the
+timestamp values, the same few option layouts are sent by all clients of
+an OS, so the decoded signature parts are memoized by the option bytes
+without the timestamp values and only the timestamps are read per packet.
+On a miss, decode_options() decodes the bytes in a single pass.
+decode_tcp_options_dpkt() is the dpkt based reference it is compared with.
 """
 
 # TCP Options (opt_type) - http://www.iana.org/assignments/tcp-parameters
@@ -64,6 +73,9 @@ def decode_tcp_options(opts):
     window_scaling = None
 
     for opt in opts:
+        # dpkt's parse_opts() appends None for a truncated option
+        if opt is None:
+            break
         option_type, option_value = opt
         if option_type == TCP_OPT_EOL:  # End of options list
             str_opts = str_opts + 'E,'
@@ -77,8 +89,12 @@ def decode_tcp_options(opts):
                 log('failed to parse TCP_OPT_MSS: {}'.format(
                     str(e)), 'zardaxt_tcp_options', level='ERROR')
         elif option_type == TCP_OPT_WSCALE:  # Window scaling
-            window_scaling = struct.unpack('!b', option_value)[0]
-            str_opts = str_opts + 'W' + str(window_scaling) + ','
+            try:
+                window_scaling = struct.unpack('!b', option_value)[0]
+                str_opts = str_opts + 'W' + str(window_scaling) + ','
+            except Exception as e:
+                log('failed to parse TCP_OPT_WSCALE: {}'.format(
+                    str(e)), 'zardaxt_tcp_options', level='ERROR')
         elif option_type == TCP_OPT_SACKOK:  # Selective Acknowledgement permitted
             str_opts = str_opts + 'S,'
         elif option_type == TCP_OPT_SACK:  # Selective ACKnowledgement (SACK)
@@ -88,14 +104,9 @@ def decode_tcp_options(opts):
         elif option_type == TCP_OPT_ECHOREPLY:
             str_opts = str_opts + 'F,'
         elif option_type == TCP_OPT_TIMESTAMP:
-            try:
-                str_opts = str_opts + 'T,'
-                timestamp = struct.unpack('!I', option_value[0:4])[0]
-                timestamp_echo_reply = struct.unpack(
-                    '!I', option_value[4:8])[0]
-            except Exception as e:
-                log('failed to parse TCP_OPT_TIMESTAMP: {}'.format(
-                    str(e)), 'zardaxt_tcp_options', level='ERROR')
+            str_opts = str_opts + 'T,'
+            timestamp, timestamp_echo_reply = decode_timestamp(
+                option_value, timestamp, timestamp_echo_reply)
         elif option_type == TCP_OPT_POCONN:
             str_opts = str_opts + 'P,'
         elif option_type == TCP_OPT_POSVC:
@@ -104,3 +115,207 @@ def decode_tcp_options(opts):
             str_opts = str_opts + 'U' + str(option_type) + ','
 
     return (str_opts, timestamp, timestamp_echo_reply, mss, window_scaling)
+
+
+def decode_tcp_options_dpkt(buf):
+    """
+    Decodes the raw TCP option bytes with dpkt's parse_opts(), the original
+    code path.
+
+    Returns:
+        tuple: (str_opts, timestamp, timestamp_echo_reply, mss, window_scaling,
+            tcp_options_ordered)
+    """
+    str_opts, timestamp, timestamp_echo_reply, mss, window_scaling = \
+        decode_tcp_options(parse_opts(buf))
+    ordered = ''.join([e[0] for e in str_opts.split(',') if e])
+    return str_opts, timestamp, timestamp_echo_reply, mss, window_scaling, ordered
+
+
+def decode_timestamp(option_value, timestamp, timestamp_echo_reply):
+    """
+    Returns:
+        tuple: (timestamp, timestamp_echo_reply), the passed values
+            are kept if the option is too short
+    """
+    try:
+        timestamp = struct.unpack('!I', option_value[0:4])[0]
+        timestamp_echo_reply = struct.unpack(
+            '!I', option_value[4:8])[0]
+    except Exception as e:
+        log('failed to parse TCP_OPT_TIMESTAMP: {}'.format(
+            str(e)), 'zardaxt_tcp_options', level='ERROR')
+    return timestamp, timestamp_echo_reply
+
+
+# option bytes without the timestamp values ->
+# (str_opts, tcp_options_ordered, mss, window_scaling, fast path offset)
+OPTIONS_CACHE_SIZE = 4096
+options_cache = LRUCache(OPTIONS_CACHE_SIZE)
+# kind and length of a timestamp option
+TIMESTAMP_OPTION = bytes([TCP_OPT_TIMESTAMP, 10])
+TIMESTAMPS = struct.Struct('!II')
+MSS = struct.Struct('!h')
+WSCALE = struct.Struct('!b')
+# the options decode_tcp_options() only writes a letter for
+OPTION_LETTERS = {
+    TCP_OPT_EOL: 'E',
+    TCP_OPT_NOP: 'N',
+    TCP_OPT_SACKOK: 'S',
+    TCP_OPT_SACK: 'K',
+    TCP_OPT_ECHO: 'J',
+    TCP_OPT_ECHOREPLY: 'F',
+    TCP_OPT_POCONN: 'P',
+    TCP_OPT_POSVC: 'R',
+}
+
+
+def decode_options(buf):
+    """
+    decode_tcp_options(parse_opts(buf)) in a single pass over the raw
+    option bytes, without building the list of option tuples.
+
+    Returns:
+        tuple: (str_opts, timestamp, timestamp_echo_reply, mss, window_scaling)
+    """
+    str_opts = []
+    mss = 0
+    timestamp_echo_reply = ''
+    timestamp = ''
+    window_scaling = None
+    i = 0
+    end = len(buf)
+    while i < end:
+        option_type = buf[i]
+        if option_type > TCP_OPT_NOP:
+            if i + 1 >= end:
+                # the length is missing, parse_opts() stops here
+                break
+            length = max(2, buf[i + 1])
+            option_value = buf[i + 2:i + length]
+            i += length
+        else:
+            option_value = b''
+            i += 1
+        letter = OPTION_LETTERS.get(option_type)
+        if letter is not None:
+            str_opts.append(letter)
+        elif option_type == TCP_OPT_MSS:
+            try:
+                mss = MSS.unpack(option_value)[0]
+                str_opts.append('M' + str(mss))
+            except struct.error as e:
+                log('failed to parse TCP_OPT_MSS: {}'.format(
+                    str(e)), 'zardaxt_tcp_options', level='ERROR')
+        elif option_type == TCP_OPT_WSCALE:
+            try:
+                window_scaling = WSCALE.unpack(option_value)[0]
+                str_opts.append('W' + str(window_scaling))
+            except struct.error as e:
+                log('failed to parse TCP_OPT_WSCALE: {}'.format(
+                    str(e)), 'zardaxt_tcp_options', level='ERROR')
+        elif option_type == TCP_OPT_TIMESTAMP:
+            str_opts.append('T')
+            timestamp, timestamp_echo_reply = decode_timestamp(
+                option_value, timestamp, timestamp_echo_reply)
+        else:  # unknown TCP option. Just store the opt_type
+            str_opts.append('U' + str(option_type))
+
+    str_opts = ''.join([opt + ',' for opt in str_opts])
+    return (str_opts, timestamp, timestamp_echo_reply, mss, window_scaling)
+
+
+def mask_timestamps(buf):
+    """Walk the options like dpkt's parse_opts() does, without decoding them.
+
+    Returns:
+        (bytes, list): The option bytes without the values of the timestamp
+            options and the (start, end) offsets of these values in buf
+    """
+    ts_values = []
+    i = 0
+    end = len(buf)
+    while i < end:
+        option_type = buf[i]
+        if option_type > TCP_OPT_NOP:
+            if i + 1 >= end:
+                break
+            length = max(2, buf[i + 1])
+            if option_type == TCP_OPT_TIMESTAMP:
+                ts_values.append((i + 2, min(i + length, end)))
+            i += length
+        else:
+            i += 1
+    if not ts_values:
+        return buf, ts_values
+    parts = []
+    last = 0
+    for start, stop in ts_values:
+        parts.append(buf[last:start])
+        last = stop
+    parts.append(buf[last:])
+    return b''.join(parts), ts_values
+
+
+def fast_path_offset(buf, ts_values):
+    """
+    The offset of the only timestamp option (-1 without one) that
+    decode_tcp_options_raw() can find without walking the options.
+    """
+    if not ts_values:
+        return -1
+    start, end = ts_values[0]
+    if len(ts_values) == 1 and buf[start - 1] == 10 and end - start == 8:
+        return start - 2
+    return -2
+
+
+def decode_tcp_options_raw(buf):
+    """
+    Decodes the raw TCP option bytes, with the same results as
+    decode_tcp_options(parse_opts(buf)).
+
+    Returns:
+        tuple: (str_opts, timestamp, timestamp_echo_reply, mss, window_scaling,
+            tcp_options_ordered)
+    """
+    # Fast path: guess that the first 08 0a bytes are the only timestamp
+    # option. If an entry was cached for a timestamp option at exactly this
+    # offset, buf walks like the options of that entry (they only differ in
+    # the timestamp values), so the guess was right.
+    offset = buf.find(TIMESTAMP_OPTION)
+    signature = None
+    if offset < 0:
+        signature = options_cache.get(buf)
+    elif offset + 10 <= len(buf):
+        signature = options_cache.get(buf[:offset + 2] + buf[offset + 10:])
+    if signature is not None and signature[4] == offset:
+        str_opts, ordered, mss, window_scaling, _ = signature
+        if offset < 0:
+            return str_opts, '', '', mss, window_scaling, ordered
+        timestamp, timestamp_echo_reply = TIMESTAMPS.unpack_from(buf, offset + 2)
+        return str_opts, timestamp, timestamp_echo_reply, mss, window_scaling, ordered
+
+    key, ts_values = mask_timestamps(buf)
+    signature = options_cache.get(key)
+    if signature is None:
+        str_opts, timestamp, timestamp_echo_reply, mss, window_scaling = decode_options(buf)
+        ordered = ''.join([opt[0] for opt in str_opts.split(',') if opt])
+        options_cache.put(key, (str_opts, ordered, mss, window_scaling,
+                                fast_path_offset(buf, ts_values)))
+        return str_opts, timestamp, timestamp_echo_reply, mss, window_scaling, ordered
+
+    str_opts, ordered, mss, window_scaling, _ = signature
+    timestamp = ''
+    timestamp_echo_reply = ''
+    for start, end in ts_values:
+        if end - start >= 8:
+            timestamp, timestamp_echo_reply = TIMESTAMPS.unpack_from(buf, start)
+        else:
+            timestamp, timestamp_echo_reply = decode_timestamp(
+                buf[start:end], timestamp, timestamp_echo_reply)
+    return str_opts, timestamp, timestamp_echo_reply, mss, window_scaling, ordered
+
+
+def get_options_cache_stats():
+    return options_cache.stats()
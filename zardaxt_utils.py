@@ -1,16 +1,95 @@
 import json
 import os
 from zardaxt_logging import log
+from zardaxt_cache import LRUCache
 import time
 
 databaseLoaded = False
 dbList = []
 os_sample_count = {}
 
+# The per field weights of the scoring algorithm. tcp_options and
+# tcp_options_ordered are not part of this list, because only one
+# of them may score (see score_fp_linear())
+FIELD_WEIGHTS = [
+    ('ip_id', 1.5),
+    ('ip_tos', 0.25),
+    ('ip_total_length', 2.5),
+    ('ip_ttl', 2),
+    ('tcp_off', 2.5),
+    ('tcp_timestamp_echo_reply', 2),
+    ('tcp_window_scaling', 2),
+    ('tcp_window_size', 2),
+    ('tcp_flags', 0.25),
+    ('tcp_mss', 1.5),
+]
+TCP_OPTIONS_WEIGHT = 4
+TCP_OPTIONS_ORDERED_WEIGHT = 2.5
+# Hardcoded for performance reasons
+OS_CLASSES = ['Android', 'Windows', 'Mac OS', 'iOS', 'Linux', 'Chromium OS']
+
+# field -> value -> [(os_name, count), ...]
+# Built once from dbList in build_score_tables()
+score_tables = {}
+
+# The fields read by the scoring algorithm, in signature order
+SCORE_FIELDS = [field for field, _ in FIELD_WEIGHTS] + \
+    ['tcp_options', 'tcp_options_ordered']
+
+# The scoring backend used by make_os_guess(), see set_scoring_backend()
+scoring_backend = 'table'
+numpy_scorer = None
+
+# normalized signature -> avg_os_score, see configure_score_cache()
+score_cache = LRUCache(10000)
+# incremented whenever the database is (re)loaded
+database_generation = 0
+
+
+def build_score_tables(entries):
+    """Build the per field lookup tables used by score_fp().
+
+    Since the score of a database entry is a sum of independent per field
+    matches, the summed score of an OS class is the sum over all fields of
+    weight * (number of entries of that OS sharing the field value).
+    Those counts are precomputed here, so that scoring a fingerprint costs
+    one dict lookup per field instead of a scan over the whole database.
+
+    The elif rule for tcp_options / tcp_options_ordered is kept by
+    counting the (tcp_options, tcp_options_ordered) pairs as well: entries
+    where both match must only receive the tcp_options weight.
+
+    Args:
+        entries (list): The database entries
+    """
+    global score_tables
+    counts = {}
+    fields = [field for field, _ in FIELD_WEIGHTS] + \
+        ['tcp_options', 'tcp_options_ordered', 'tcp_options_both']
+    for field in fields:
+        counts[field] = {}
+    for entry in entries:
+        os_name = entry['os']
+        for field in fields:
+            if field == 'tcp_options_both':
+                value = (entry['tcp_options'], entry['tcp_options_ordered'])
+            else:
+                value = entry[field]
+            per_os = counts[field].setdefault(value, {})
+            per_os[os_name] = per_os.get(os_name, 0) + 1
+
+    tables = {}
+    for field in fields:
+        tables[field] = {
+            value: list(per_os.items()) for value, per_os in counts[field].items()
+        }
+    score_tables = tables
+
 
 def maybe_load_database(databaseFile='./database/newCleaned.json'):
     global databaseLoaded
     global dbList
+    global database_generation
     if not databaseLoaded:
         # load fingerprints into database
         with open(databaseFile) as f:
@@ -20,12 +99,30 @@ def maybe_load_database(databaseFile='./database/newCleaned.json'):
                     os_sample_count[el['os']] = 0
                 os_sample_count[el['os']] += 1
             log(f'os_sample_count={os_sample_count}', 'zardaxt_utils')
+        build_score_tables(dbList)
+        if scoring_backend == 'numpy':
+            set_scoring_backend('numpy')
+        database_generation += 1
+        if score_cache is not None:
+            score_cache.clear()
 
         log('Loaded {} fingerprints from the database'.format(
             len(dbList)), 'zardaxt_utils')
         databaseLoaded = True
 
 
+def reload_database(databaseFile='./database/newCleaned.json'):
+    """Reload the database, e.g. after newCleaned.json has been updated.
+
+    Cached scores are invalidated. Scoring workers (zardaxt_scoring_pool.py)
+    keep the database they were forked with.
+    """
+    global databaseLoaded
+    databaseLoaded = False
+    os_sample_count.clear()
+    maybe_load_database(databaseFile)
+
+
 maybe_load_database()
 
 
@@ -154,6 +251,44 @@ def compute_near_timestamp_tick(hertz_observed):
 def score_fp(fp):
     """The most recent version of TCP/IP fingerprint scoring algorithm.
 
+    Computes exactly the same scores as score_fp_linear(), but uses the
+    lookup tables from build_score_tables(). The cost depends on the
+    number of scored fields, not on the size of the database.
+
+    Args:
+        fp (dict): The fingerprint to score
+
+    Returns:
+        avg_os_score: average score of this fingerprint for all OS
+    """
+    os_scores = dict.fromkeys(OS_CLASSES, 0)
+    for field, weight in FIELD_WEIGHTS:
+        for os_name, count in score_tables[field].get(fp[field], ()):
+            os_scores[os_name] += weight * count
+
+    for os_name, count in score_tables['tcp_options'].get(fp['tcp_options'], ()):
+        os_scores[os_name] += TCP_OPTIONS_WEIGHT * count
+    for os_name, count in score_tables['tcp_options_ordered'].get(fp['tcp_options_ordered'], ()):
+        os_scores[os_name] += TCP_OPTIONS_ORDERED_WEIGHT * count
+    # entries matching tcp_options must not score tcp_options_ordered as well
+    both = (fp['tcp_options'], fp['tcp_options_ordered'])
+    for os_name, count in score_tables['tcp_options_both'].get(both, ()):
+        os_scores[os_name] -= TCP_OPTIONS_ORDERED_WEIGHT * count
+
+    avg_os_score = {}
+    for os_name in os_scores:
+        avg_os_score[os_name] = round(
+            os_scores[os_name] / os_sample_count[os_name], 2)
+
+    return avg_os_score
+
+
+def score_fp_linear(fp):
+    """The reference implementation of the scoring algorithm.
+
+    Compares the fingerprint against every database entry. Kept to verify
+    score_fp() against and for the perf() comparison.
+
     Args:
         fp (dict): The fingerprint to score
 
@@ -207,6 +342,43 @@ def score_fp(fp):
     return avg_os_score
 
 
+def set_scoring_backend(name='table'):
+    """Select the scoring backend.
+
+    Args:
+        name (str): 'table' (the default), 'linear' or 'numpy'
+    """
+    global scoring_backend
+    global numpy_scorer
+    if name == 'numpy':
+        from zardaxt_numpy_scoring import NumpyScorer
+        numpy_scorer = NumpyScorer(dbList, FIELD_WEIGHTS, OS_CLASSES,
+                                   TCP_OPTIONS_WEIGHT, TCP_OPTIONS_ORDERED_WEIGHT)
+    elif name not in ['table', 'linear']:
+        raise Exception('Unknown scoring_backend: {}'.format(name))
+    scoring_backend = name
+    log('Using scoring backend {}'.format(name), 'zardaxt_utils')
+
+
+def score_normalized_fp(fp):
+    """Score a normalized fingerprint with the selected backend."""
+    if scoring_backend == 'numpy':
+        return numpy_scorer.score(fp)
+    if scoring_backend == 'linear':
+        return score_fp_linear(fp)
+    return score_fp(fp)
+
+
+def score_normalized_fps(fps):
+    """Score a list of normalized fingerprints with the selected backend.
+
+    The numpy backend scores the whole list with a single vectorized pass.
+    """
+    if scoring_backend == 'numpy':
+        return numpy_scorer.score_many(fps)
+    return [score_normalized_fp(fp) for fp in fps]
+
+
 def normalize_fp(fp):
     """
     Normalize the fingerprint.
@@ -220,15 +392,155 @@ def normalize_fp(fp):
     return new_fp
 
 
-def make_os_guess(fp):
+def fp_signature(fp):
+    """
+    The tuple of normalized scoring fields of a fingerprint.
+
+    Two fingerprints with the same signature get the same scores,
+    therefore the signature is used as key of the score cache.
+    """
+    signature = []
+    for field in SCORE_FIELDS:
+        value = fp[field]
+        if field == 'ip_ttl':
+            value = compute_near_ttl(value)
+        elif field == 'ip_id':
+            value = compute_ip_id(value)
+        elif field == 'tcp_timestamp_echo_reply':
+            value = getTcpTimestamp(value)
+        signature.append(value)
+    return tuple(signature)
+
+
+def configure_score_cache(max_size=10000, prewarm=False):
+    """Configure the LRU cache of fingerprint scores.
+
+    Args:
+        max_size (int): Maximum number of cached signatures, 0 disables the cache
+        prewarm (bool): Score every distinct signature of the database upfront
+    """
+    global score_cache
+    score_cache = LRUCache(max_size) if max_size > 0 else None
+    if score_cache is not None and prewarm:
+        prewarm_score_cache()
+
+
+def prewarm_score_cache():
+    """Put the scores of all distinct database signatures into the cache.
+
+    The database entries are already normalized, so their fields are used as is.
+    """
+    signatures = list(dict.fromkeys(
+        tuple(entry[field] for field in SCORE_FIELDS) for entry in dbList))
+    t0 = time.time()
+    all_scores = score_normalized_fps(
+        [dict(zip(SCORE_FIELDS, signature)) for signature in signatures])
+    for signature, avg_os_score in zip(signatures, all_scores):
+        score_cache.put(signature, avg_os_score)
+    log('Prewarmed score cache with {} signatures in {}ms'.format(
+        len(signatures), round((time.time() - t0) * 1000, 2)), 'zardaxt_utils')
+
+
+def get_score_cache_stats():
+    if score_cache is None:
+        return None
+    return score_cache.stats()
+
+
+def guess_os_scores(fp, scorer=None):
+    """
+    Score the fingerprint, using the score cache when possible.
+
+    Args:
+        scorer (function): Scores a normalized fingerprint on a cache miss,
+            score_normalized_fp() by default (see zardaxt_scoring_pool.py)
+
+    Returns:
+        avg_os_score: average score of this fingerprint for all OS
+    """
+    return dict(shared_os_scores(fp, scorer))
+
+
+def shared_os_scores(fp, scorer=None):
+    """
+    Like guess_os_scores(), but returns the cached avg_os_score itself,
+    which is shared and must not be modified.
+    """
+    cache = score_cache
+    signature = fp_signature(fp)
+    if cache is not None:
+        avg_os_score = cache.get(signature)
+        if avg_os_score is not None:
+            return avg_os_score
+    generation = database_generation
+    avg_os_score = (scorer or score_normalized_fp)(dict(zip(SCORE_FIELDS, signature)))
+    # do not cache scores computed against a database that has been reloaded meanwhile
+    if cache is not None and generation == database_generation:
+        cache.put(signature, avg_os_score)
+    return avg_os_score
+
+
+def batch_os_scores(fps, batch_scorer=None):
+    """
+    Score a batch of fingerprints, every distinct signature only once.
+
+    Cache misses are scored together with score_normalized_fps() (a single
+    pass with the numpy backend) or batch_scorer (see zardaxt_scoring_pool.py).
+
+    Returns:
+        list: avg_os_score of every fingerprint, in the order of fps
+    """
+    cache = score_cache
+    signatures = [fp_signature(fp) for fp in fps]
+    scores = {}
+    for signature in signatures:
+        if signature not in scores:
+            scores[signature] = cache.get(signature) if cache is not None else None
+    missing = [signature for signature, avg_os_score in scores.items() if avg_os_score is None]
+    if missing:
+        generation = database_generation
+        normalized_fps = [dict(zip(SCORE_FIELDS, signature)) for signature in missing]
+        for signature, avg_os_score in zip(
+                missing, (batch_scorer or score_normalized_fps)(normalized_fps)):
+            scores[signature] = avg_os_score
+            if cache is not None and generation == database_generation:
+                cache.put(signature, avg_os_score)
+    return [dict(scores[signature]) for signature in signatures]
+
+
+def classify_fp(fp):
+    """
+    Score the fingerprint ahead of a lookup, see zardaxt_classifier.py.
+
+    Returns:
+        tuple: (database generation, avg_os_score)
+    """
+    generation = database_generation
+    return generation, shared_os_scores(fp)
+
+
+def current_scores(scores):
+    """
+    Returns:
+        avg_os_score: A copy of the avg_os_score returned by classify_fp(),
+            None if there is none or the database was reloaded meanwhile
+    """
+    if scores is None or scores[0] != database_generation:
+        return None
+    return dict(scores[1])
+
+
+def make_os_guess(fp, avg_os_score=None, scorer=None):
     """
     Return the highest scoring TCP/IP fingerprinting match from the database.
     If there is more than one highest scoring match, return all the highest scoring matches.
 
     As a second guess, output the operating system with the highest, normalized average score.
+    The fingerprint is only scored (with scorer, see guess_os_scores()) when no
+    avg_os_score is passed.
     """
-    norm_fp = normalize_fp(fp)
-    avg_os_score = score_fp(norm_fp)
+    if avg_os_score is None:
+        avg_os_score = guess_os_scores(fp, scorer)
     return {
         'avg_score_os_class': avg_os_score,
         'fp': fp,
@@ -240,20 +552,38 @@ def make_os_guess(fp):
     }
 
 
-def perf():
+def perf(corpus='database/duplicates.json'):
     # using the TCP/IP fingerprints that didn't add any entropy as a
     # test corpus to check the performance
-    some_fps = json.load(open('database/duplicates.json', 'r'))
-    some_fps = some_fps
+    if not os.path.exists(corpus):
+        corpus = './database/newCleaned.json'
+    some_fps = json.load(open(corpus, 'r'))
     N = len(some_fps)
+    for name, scorer in [('linear', score_fp_linear), ('table', score_fp)]:
+        t0 = time.time()
+        for fp in some_fps:
+            avg_os_score = scorer(fp)
+            # print(fp['os'], avg_os_score)
+        t1 = time.time()
+        totalMs = round((t1-t0) * 1000, 2)
+        perScoreMs = round(totalMs/N, 3)
+        print(name, N, totalMs, perScoreMs)
+    mismatches = [fp for fp in some_fps if score_fp(fp) != score_fp_linear(fp)]
+    print('mismatches between linear and table scoring:', len(mismatches))
+
+    try:
+        set_scoring_backend('numpy')
+    except Exception as e:
+        print('skipping numpy backend:', e)
+        return
     t0 = time.time()
-    for fp in some_fps:
-        avg_os_score = score_fp(fp)
-        # print(fp['os'], avg_os_score)
+    batch_scores = score_normalized_fps(some_fps)
     t1 = time.time()
     totalMs = round((t1-t0) * 1000, 2)
-    perScoreMs = round(totalMs/N, 3)
-    print(N, totalMs, perScoreMs)
+    print('numpy (batch)', N, totalMs, round(totalMs/N, 3))
+    mismatches = [fp for fp, avg_os_score in zip(some_fps, batch_scores)
+                  if avg_os_score != score_fp(fp)]
+    print('mismatches between numpy and table scoring:', len(mismatches))
 
 
 if __name__ == '__main__':